@@ -1,5 +1,6 @@
 import * as topojsonServer from "https://esm.sh/topojson-server@3";
 import * as topojsonClient from "https://esm.sh/topojson-client@3";
+import { loadShardIndex, loadCommunityShard, communityOf } from "./shards.js";
 
 // --- Setup ---
 const width = 800;
@@ -55,6 +56,25 @@ let currentFilters = {
 };
 
 let currentFilterCommunity = 'Todos';
+let communitiesCsv = null; // Only loaded if the shards were not exported
+let communityRequest = 0; // Latest community selection, so a slower earlier one is not drawn over it
+
+// Communities of all years for a diagnosis (its COD in diag.csv), from its shard, loaded on demand,
+// or from communities.csv if the site has no shards
+async function loadCommunities(diagCode) {
+    let index;
+    try {
+        index = await loadShardIndex();
+    } catch (error) {
+        if (communitiesCsv === null) communitiesCsv = d3.csv("static/data/communities.csv");
+        return (await communitiesCsv).filter(d => d.DIAG_PRINC === diagCode);
+    }
+    const shard = await loadCommunityShard(diagCode);
+    if (shard === null) return [];
+    return index.municipalities
+        .map(cdMun => ({ municipality: String(cdMun), community_id: communityOf(shard, cdMun), DIAG_PRINC: diagCode }))
+        .filter(d => d.community_id !== undefined);
+}
 
 // --- HELPER: Multi-select Logic ---
 function createMultiSelect(containerId, options, selectedValues) {
@@ -176,9 +196,8 @@ Promise.all([
     d3.csv("static/data/diag.csv"),
     d3.json("static/data/brazil_municipalities.geojson"),
     d3.json("static/data/brazil-states.geojson"),
-    d3.csv("static/data/states_graph.csv"),
-    d3.csv("static/data/communities.csv")    
-]).then(([muniData,muniInfo,diagInfo,muniGeo, stateGeo, stateData, communitiesData]) => {
+    d3.csv("static/data/states_graph.csv")
+]).then(([muniData,muniInfo,diagInfo,muniGeo, stateGeo, stateData]) => {
     // Store raw data
     rawStateData = stateData;
 
@@ -228,15 +247,7 @@ Promise.all([
         };
     })
 
-    communitiesData = communitiesData.map(d => {
-        const munInfo = muniInfoMap.get(d.municipality);
-        const diag = diagInfoMap.get(d.DIAG_PRINC);
-        return {
-            municipality: munInfo?.name || 'Unknown',
-            community_id: d.community_id,
-            DIAG_PRINC: diag?.name || 'Unknown',
-        };
-    });
+    const diagCodeByName = new Map(diagInfo.map(d => [d.DIAG_PRINC, d.COD]));
 
     // --- Setup Multi-Select Dropdowns ---
     
@@ -390,13 +401,19 @@ Promise.all([
         updateFilterStatus();
     }
 
-    function refreshCommunityViz() {
-        const filteredCommunitiesData = communitiesData.filter(d => {
-            const diagnosisMatch = d.DIAG_PRINC === currentFilterCommunity;
-            return diagnosisMatch;
-        });
+    async function refreshCommunityViz() {
+        const request = ++communityRequest;
+        const diagnosis = currentFilterCommunity;
+        const communities = await loadCommunities(diagCodeByName.get(diagnosis));
+        if (request !== communityRequest) return;
+
+        const filteredCommunitiesData = communities.map(d => ({
+            municipality: muniInfoMap.get(d.municipality)?.name || 'Unknown',
+            community_id: d.community_id,
+            DIAG_PRINC: diagnosis,
+        }));
 
-        d3.select("#filter-status-community").text(`Mostrando: ${currentFilterCommunity}`);
+        d3.select("#filter-status-community").text(`Mostrando: ${diagnosis}`);
 
         drawCommunitiesMap(muniGeo, filteredCommunitiesData, stateGeo, muniTopology);
     }
@@ -0,0 +1,74 @@
+// --- Sharded data (written by src/site_export.py) ---
+// Each shard is a binary file of typed arrays laid out back to back, indexed by the
+// position of the municipality in index.json, so a municipality's connections are found in O(1).
+
+const SHARDS_DIR = "static/data/shards";
+
+let shardIndex = null;
+let positionByMuni = null;
+const shardCache = new Map();
+
+export async function loadShardIndex() {
+    if (shardIndex === null) {
+        shardIndex = await d3.json(`${SHARDS_DIR}/index.json`);
+        positionByMuni = new Map(shardIndex.municipalities.map((cdMun, i) => [String(cdMun), i]));
+    }
+    return shardIndex;
+}
+
+function viewArrays(buffer, layout, lengths) {
+    const arrays = {};
+    let byteOffset = 0;
+    layout.forEach(([name, type], i) => {
+        const ArrayType = type === "float32" ? Float32Array : Int32Array;
+        arrays[name] = new ArrayType(buffer, byteOffset, lengths[i]);
+        byteOffset += lengths[i] * 4;
+    });
+    return arrays;
+}
+
+async function loadShard(kind, diag, year) {
+    const index = await loadShardIndex();
+    const file = index[kind].shards[`${diag}/${year}`];
+    if (file === undefined) return null;
+    if (!shardCache.has(file)) {
+        shardCache.set(file, d3.buffer(`${SHARDS_DIR}/${file}`).then(buffer => {
+            const n = index.municipalities.length;
+            if (kind === "communities") {
+                return viewArrays(buffer, index[kind].layout, [n]);
+            }
+            const nnz = new Int32Array(buffer, n * 4, 1)[0];
+            return viewArrays(buffer, index[kind].layout, [n + 1, nnz, nnz, nnz]);
+        }));
+    }
+    return shardCache.get(file);
+}
+
+// Diagnosis code as in diag.csv (0 for all of them) and year ("Todos" for all of them)
+export function loadGraphShard(diag = 0, year = "Todos") {
+    return loadShard("graph", diag, year);
+}
+
+export function loadCommunityShard(diag = 0, year = "Todos") {
+    return loadShard("communities", diag, year);
+}
+
+export function connectionsOf(shard, cdMun) {
+    const i = positionByMuni.get(String(cdMun));
+    if (i === undefined) return [];
+    const connections = [];
+    for (let j = shard.offsets[i]; j < shard.offsets[i + 1]; j++) {
+        connections.push({
+            CD_MUN_RES: cdMun,
+            CD_MUN_MOV: shardIndex.municipalities[shard.mov[j]],
+            HOSPITALIZACOES: shard.hosp[j],
+            DISTANCE: shard.dist[j]
+        });
+    }
+    return connections;
+}
+
+export function communityOf(shard, cdMun) {
+    const i = positionByMuni.get(String(cdMun));
+    return i === undefined || shard.community_id[i] < 0 ? undefined : shard.community_id[i];
+}
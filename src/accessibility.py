@@ -0,0 +1,97 @@
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from src.cube import load_cube
+from src.geometry import load_centroids
+
+
+ACCESSIBILITY_PATH = 'data/agg_data/accessibility.parquet'
+EARTH_RADIUS = 6371
+
+
+def to_unit_sphere(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Convert coordinates in decimal degrees to points (x, y, z) on the unit sphere."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_km(chord: np.ndarray) -> np.ndarray:
+    """Convert the straight-line distance between points on the unit sphere to the great circle distance (km)."""
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def nearest_facilities(points: np.ndarray, facilities: np.ndarray, k: int) -> np.ndarray:
+    """ Great circle distances (km) from each point to its k nearest facilities, nearest first.
+
+        The chord between points on the unit sphere grows with the great circle distance, so the
+        nearest facilities in 3D are the nearest on the Earth, and the KD-tree answers all the points
+        of a batch at once. Points with fewer than k facilities get NaN for the missing ones.
+
+    Args:
+        points (np.ndarray): The (n, 3) points on the unit sphere of the origins.
+        facilities (np.ndarray): The (m, 3) points on the unit sphere of the facilities.
+        k (int): Number of nearest facilities.
+
+    Returns:
+        np.ndarray: The (n, k) distances.
+    """
+    chord, _ = cKDTree(facilities).query(points, k=k)
+    chord = chord.reshape(len(points), k)
+    return np.where(np.isinf(chord), np.nan, chord_to_km(np.where(np.isinf(chord), 0, chord)))
+
+
+def accessibility(k: int=3) -> pd.DataFrame:
+    """ Compare the distance to the nearest municipalities treating each diagnosis with the observed one.
+
+        The facilities of a diagnosis and year are the municipalities where any resident was
+        hospitalized for it (MUNIC_MOV), and the origins are the municipalities of residence with
+        hospitalizations for it. The observed distance is the mean distance travelled, weighted by
+        hospitalizations, as the DISTANCE of counties.csv.
+
+    Args:
+        k (int, optional): Number of nearest facilities. Defaults to 3.
+
+    Returns:
+        pd.DataFrame: By CD_MUN_RES, ANO_CMPT and DIAG_PRINC, the HOSPITALIZACOES, the OBSERVED_DISTANCE,
+            the NEAREST_DISTANCE to the nearest facility, the MEAN_K_DISTANCE to the k nearest ones and
+            EXCESS_TRAVEL, the observed minus the nearest distance (km).
+    """
+    centroids = load_centroids()
+    points = pd.Series(list(to_unit_sphere(centroids['LAT'].values, centroids['LON'].values)), index=centroids.index)
+
+    observed = load_cube(['CD_MUN_RES', 'ANO_CMPT', 'DIAG_PRINC'])
+    observed = observed[observed['CD_MUN_RES'].isin(centroids.index)]
+    observed['OBSERVED_DISTANCE'] = observed['HOSPxDIST'] / observed['HOSPITALIZACOES']
+    flows = load_cube(['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT', 'DIAG_PRINC'])
+    facilities = flows[(flows['HOSPITALIZACOES'] > 0) & flows['CD_MUN_MOV'].isin(centroids.index)] \
+        .groupby(['DIAG_PRINC', 'ANO_CMPT'])['CD_MUN_MOV'].unique()
+
+    result = []
+    for (diag, year), origins in observed.groupby(['DIAG_PRINC', 'ANO_CMPT']):
+        if (diag, year) not in facilities:
+            continue
+        distances = nearest_facilities(np.stack(points[origins['CD_MUN_RES']].values),
+                                       np.stack(points[facilities[(diag, year)]].values), k)
+        result.append(origins[['CD_MUN_RES', 'ANO_CMPT', 'DIAG_PRINC', 'HOSPITALIZACOES', 'OBSERVED_DISTANCE']].assign(
+            NEAREST_DISTANCE=distances[:, 0],
+            MEAN_K_DISTANCE=np.nanmean(distances, axis=1),
+        ))
+    result = pd.concat(result, ignore_index=True)
+    result['EXCESS_TRAVEL'] = result['OBSERVED_DISTANCE'] - result['NEAREST_DISTANCE']
+    return result.sort_values(['CD_MUN_RES', 'ANO_CMPT', 'DIAG_PRINC'], ignore_index=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, default=3,
+                        help='Number of nearest municipalities treating the diagnosis.')
+    cli_args = parser.parse_args()
+
+    df = accessibility(cli_args.k)
+    df.astype({column: np.float32 for column in ['OBSERVED_DISTANCE', 'NEAREST_DISTANCE', 'MEAN_K_DISTANCE',
+                                                'EXCESS_TRAVEL']}).to_parquet(ACCESSIBILITY_PATH, index=False)
+    print(df[['OBSERVED_DISTANCE', 'NEAREST_DISTANCE', 'EXCESS_TRAVEL']].describe())
+    print(f"Accessibility saved to {ACCESSIBILITY_PATH}")
@@ -1,48 +1,30 @@
-import pandas as pd
-import geopandas as gpd
-from src.transform_data import get_state_name
-import geobr
-import geopandas as gpd
+from src.cube import load_cube
+from src.dimensions import diag_labels
+from src.geometry import load_states
+from src.instrument import stage
 
 
-states_gdf = geobr.read_state(year=2020)
+states_gdf = load_states()
 
-states_gdf['centroid'] = states_gdf.to_crs('+proj=cea').centroid.to_crs(states_gdf.crs)
+states_gdf.set_index('code_state', inplace=True)
 
-states_gdf.replace({'name_state': {
-    'Amazônas': 'Amazonas',
-    'Rio Grande Do Norte': 'Rio Grande do Norte',
-    'Rio Grande Do Sul': 'Rio Grande do Sul',
-    'Rio De Janeiro': 'Rio de Janeiro',
-    'Mato Grosso Do Sul': 'Mato Grosso do Sul',
-}}, inplace=True)
-
-states_gdf.set_index('name_state', inplace=True)
-
-df = pd.read_parquet('data/agg_data/hospitalizacoes.parquet')
-
-groups = pd.read_csv('data/CID10/cid10_capitulos.csv',sep=';',index_col='codigo')['descricao_breve']
-groups = groups[~groups.index.duplicated(keep='first')]
-df['DIAG_PRINC'] = df['DIAG_PRINC'].map(groups)
-
-df['UF_RES'] = get_state_name(df['MUNIC_RES'])
-df['UF_MOV'] = get_state_name(df['MUNIC_MOV'])
+df = load_cube(['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC'])
 
 df = df[df['UF_RES'] != df['UF_MOV']]
 
-df = df.groupby(['UF_RES', 'UF_MOV','ANO_CMPT','DIAG_PRINC']).agg({'HOSPITALIZACOES': 'sum'}).reset_index()
-
-df['CENTROID_RES'] = df['UF_RES'].map(states_gdf['centroid'])
-df['CENTROID_MOV'] = df['UF_MOV'].map(states_gdf['centroid'])
+df = df[['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC', 'HOSPITALIZACOES']]
 
-# separate the coordinates into two columns
-df['RES_LAT'] = df['CENTROID_RES'].apply(lambda p: p.y)
-df['RES_LON'] = df['CENTROID_RES'].apply(lambda p: p.x)
-df['MOV_LAT'] = df['CENTROID_MOV'].apply(lambda p: p.y)
-df['MOV_LON'] = df['CENTROID_MOV'].apply(lambda p: p.x)
+df['RES_LAT'] = df['UF_RES'].map(states_gdf['centroid_lat'])
+df['RES_LON'] = df['UF_RES'].map(states_gdf['centroid_lon'])
+df['MOV_LAT'] = df['UF_MOV'].map(states_gdf['centroid_lat'])
+df['MOV_LON'] = df['UF_MOV'].map(states_gdf['centroid_lon'])
 
-df.drop(columns=['CENTROID_RES', 'CENTROID_MOV'], inplace=True)
+# Names are only attached for the export
+df['UF_RES'] = df['UF_RES'].map(states_gdf['name_state'])
+df['UF_MOV'] = df['UF_MOV'].map(states_gdf['name_state'])
+df['DIAG_PRINC'] = df['DIAG_PRINC'].map(diag_labels())
+df = df.sort_values(['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC'], ignore_index=True)
 
 # Save the aggregated data to a CSV file
-df.to_csv('docs/static/data/states_graph.csv', index=False)
-
+with stage('export.states_graph', rows_out=len(df)):
+    df.to_csv('docs/static/data/states_graph.csv', index=False)
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from src.community import detect_communities
+from src.crosswalk import sih_to_cd_mun
+from src.cube import build_cube, grouping_id
+from src.dimensions import ALL, cid_to_diag
+from src.distances import build_distance_matrix, lookup_distances
+from src.instrument import INSTRUMENT_DIR_ENV, new_run_dir, stage, write_report
+from src.synthetic_data import SYNTHETIC_VERSION, generate
+from src.transform_data import agg_num_hosp_city_hospital, count_rows, list_files, to_output_schema
+
+
+BENCHMARK_DIR = 'data/benchmark'
+BASELINE_PATH = f'{BENCHMARK_DIR}/baseline.json'
+RESULTS_PATH = f'{BENCHMARK_DIR}/results.json'
+THRESHOLD = 0.2
+REPEATS = 3
+WARMUP = 1
+# Stages faster than this are reported but not compared, as their throughput is mostly noise
+MIN_SECONDS = 0.5
+
+
+def bench_ingest(data_dir: str, work_dir: str, engine: str) -> int:
+    """Aggregate the synthetic SIH files, saving the result for the next stages. Returns the rows read."""
+    rows = count_rows(list_files(data_dir=data_dir))
+    with stage(f'benchmark.ingest_{engine}'):
+        df = agg_num_hosp_city_hospital(data_dir=data_dir, engine=engine)
+    to_output_schema(df).to_parquet(os.path.join(work_dir, 'hospitalizacoes.parquet'), index=False)
+    return rows
+
+
+def bench_distances(work_dir: str) -> dict:
+    """Build the distance matrix, then look up the distance of every aggregated flow. Returns the rows of each."""
+    df = pd.read_parquet(os.path.join(work_dir, 'hospitalizacoes.parquet'))
+    df['CD_MUN_RES'] = sih_to_cd_mun(df['MUNIC_RES'])
+    df['CD_MUN_MOV'] = sih_to_cd_mun(df['MUNIC_MOV'])
+    df = df.dropna(subset=['CD_MUN_RES', 'CD_MUN_MOV']).astype({'CD_MUN_RES': np.int32, 'CD_MUN_MOV': np.int32})
+
+    # Built in the work directory, so the distance cache of the pipeline is left untouched
+    paths = os.path.join(work_dir, 'distances.npy'), os.path.join(work_dir, 'distance_index.npy')
+    with stage('benchmark.distance_matrix'):
+        build_distance_matrix(*paths)
+    index = np.load(paths[1])
+    with stage('benchmark.distance_lookup'):
+        df['DISTANCE'] = lookup_distances(df['CD_MUN_RES'].values, df['CD_MUN_MOV'].values, *paths)
+
+    df['DIAG_PRINC'] = cid_to_diag(df['DIAG_PRINC'].values)
+    df.to_parquet(os.path.join(work_dir, 'graph.parquet'), index=False)
+    return {'distance_matrix': len(index) ** 2, 'distance_lookup': len(df)}
+
+
+def bench_site_data(work_dir: str) -> int:
+    """Build the cube and the counties marginal of the site from the flows. Returns the rows of the flows."""
+    df = pd.read_parquet(os.path.join(work_dir, 'graph.parquet'))
+    with stage('benchmark.site_data'):
+        cube = build_cube(df)
+        counties = cube[cube['GROUPING_ID'] == grouping_id(['CD_MUN_RES', 'ANO_CMPT', 'DIAG_PRINC'])]
+        counties = counties.assign(DISTANCE=counties['HOSPxDIST'] / counties['HOSPITALIZACOES'],
+                                   PCT_SAME_MUN=counties['SAME_MUN'] / counties['HOSPITALIZACOES'])
+        counties.to_csv(os.path.join(work_dir, 'counties.csv'), index=False)
+    return len(df)
+
+
+def bench_community(work_dir: str, engine: str) -> int:
+    """Detect the communities of the graph of all diagnoses and years. Returns the number of edges."""
+    df = pd.read_parquet(os.path.join(work_dir, 'graph.parquet'))
+    df = df.groupby(['CD_MUN_RES', 'CD_MUN_MOV'], as_index=False)['HOSPITALIZACOES'].sum()
+    with stage(f'benchmark.community_{engine}'):
+        detect_communities((ALL, ALL, df['CD_MUN_MOV'].values, df['CD_MUN_RES'].values,
+                            df['HOSPITALIZACOES'].values, engine, 0, None))
+    return len(df)
+
+
+def run_isolated(func, *args):
+    """Run a benchmark stage in a fresh process, so its peak RSS is not the one of the stages before it."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def run_stages(data_dir: str, work_dir: str, engines: list[str], community_engine: str) -> dict:
+    """Run every benchmark stage once, each in a fresh process. Returns the rows processed by stage."""
+    rows = {f'ingest_{engine}': run_isolated(bench_ingest, data_dir, work_dir, engine) for engine in engines}
+    rows.update(run_isolated(bench_distances, work_dir))
+    rows['site_data'] = run_isolated(bench_site_data, work_dir)
+    rows[f'community_{community_engine}'] = run_isolated(bench_community, work_dir, community_engine)
+    return rows
+
+
+def run_benchmarks(data_dir: str, engines: list[str], community_engine: str, repeats: int=REPEATS,
+                   warmup: int=WARMUP) -> dict:
+    """ Run every benchmark stage and measure its throughput.
+
+        The stages are first run warmup times without being measured, so the page cache and the
+        imports are warm, then repeats times. The times of a stage are the fastest of its repeats,
+        the least disturbed by other work on the machine, and its peak RSS the largest one.
+
+    Args:
+        data_dir (str): The directory of the synthetic SIH files.
+        engines (list[str]): The ingest engines to benchmark.
+        community_engine (str): The community detection engine to benchmark.
+        repeats (int, optional): Number of measured runs of each stage. Defaults to REPEATS.
+        warmup (int, optional): Number of unmeasured runs before them. Defaults to WARMUP.
+
+    Returns:
+        dict: By stage, the rows processed, wall and CPU time, peak RSS, rows per second and the wall
+            time of each repeat.
+    """
+    run_dir = new_run_dir()
+    work_dir = os.path.join(run_dir, 'work')
+    os.makedirs(work_dir)
+
+    for _ in range(warmup):
+        run_stages(data_dir, work_dir, engines, community_engine)
+    # Only the processes started from here on record their stages
+    os.environ[INSTRUMENT_DIR_ENV] = run_dir
+    for _ in range(repeats):
+        rows = run_stages(data_dir, work_dir, engines, community_engine)
+    del os.environ[INSTRUMENT_DIR_ENV]
+    shutil.rmtree(work_dir)
+
+    records = dict()
+    with open(write_report(run_dir, benchmark=True, repeats=repeats, warmup=warmup)) as f:
+        for record in json.load(f)['stages']:
+            if record['stage'].startswith('benchmark.'):
+                records.setdefault(record['stage'].removeprefix('benchmark.'), []).append(record)
+
+    results = dict()
+    for name in rows:
+        wall = [record['wall_seconds'] for record in records[name]]
+        results[name] = {
+            'rows': rows[name],
+            'wall_seconds': min(wall),
+            'cpu_seconds': min(record['cpu_seconds'] + record['children_cpu_seconds'] for record in records[name]),
+            # Each run has a fresh process, so its peaks so far, and the ones of its finished children, are the stage's
+            'peak_rss_bytes': max(max(record['peak_rss_bytes'] or record['process_peak_rss_so_far_bytes'],
+                                      record['children_peak_rss_so_far_bytes']) for record in records[name]),
+            'rows_per_second': rows[name] / min(wall),
+            'wall_seconds_runs': wall,
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_seconds: float=MIN_SECONDS) -> list[str]:
+    """ Print the results next to the baseline and list the stages whose throughput fell more than the threshold.
+
+        Stages that took less than min_seconds, now or in the baseline, are not compared.
+    """
+    regressions = []
+    print(f"{'stage':<22}{'rows':>12}{'seconds':>10}{'peak RSS MB':>13}{'rows/s':>14}{'baseline':>14}{'change':>9}")
+    for name, result in results.items():
+        line = f"{name:<22}{result['rows']:>12}{result['wall_seconds']:>10.2f}" \
+               f"{result['peak_rss_bytes'] / 2**20:>13.0f}{result['rows_per_second']:>14.0f}"
+        if name in baseline:
+            change = result['rows_per_second'] / baseline[name]['rows_per_second'] - 1
+            line += f"{baseline[name]['rows_per_second']:>14.0f}{change:>+9.1%}"
+            if min(result['wall_seconds'], baseline[name]['wall_seconds']) < min_seconds:
+                line += '  too short to compare'
+            elif change < -threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000,
+                        help='Number of synthetic hospitalizations (e.g. 1M to 500M).')
+    parser.add_argument('--years', type=int, nargs='+', default=[2024])
+    parser.add_argument('--engines', nargs='+', choices=['pandas', 'arrow', 'duckdb'], default=['pandas', 'arrow'],
+                        help='Ingest engines to benchmark.')
+    parser.add_argument('--community-engine', choices=['infomap', 'leiden'], default='infomap')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Largest accepted throughput drop from the baseline, as a fraction.')
+    parser.add_argument('--repeats', type=int, default=REPEATS,
+                        help='Measured runs of each stage, whose fastest is compared.')
+    parser.add_argument('--warmup', type=int, default=WARMUP, help='Unmeasured runs of each stage before them.')
+    parser.add_argument('--min-seconds', type=float, default=MIN_SECONDS,
+                        help='Shortest stage duration whose throughput is compared.')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline.')
+    cli_args = parser.parse_args()
+    if cli_args.repeats < 1:
+        parser.error('--repeats must be at least 1')
+
+    # The synthetic data is reused by the runs with the same scale, as it is generated with a fixed seed
+    data_dir = os.path.join(BENCHMARK_DIR, f"SIH_v{SYNTHETIC_VERSION}_{cli_args.rows}_{'_'.join(map(str, cli_args.years))}")
+    if not os.path.exists(data_dir):
+        print(f"Generating {cli_args.rows} synthetic hospitalizations in {data_dir}...")
+        generate(cli_args.rows, cli_args.years, data_dir + '.tmp')
+        os.replace(data_dir + '.tmp', data_dir)
+
+    results = run_benchmarks(data_dir, cli_args.engines, cli_args.community_engine, cli_args.repeats, cli_args.warmup)
+    scale = {'rows': cli_args.rows, 'years': cli_args.years, 'synthetic_version': SYNTHETIC_VERSION}
+    with open(RESULTS_PATH, 'w') as f:
+        json.dump({**scale, 'stages': results}, f, indent=1)
+
+    baseline = dict()
+    if os.path.exists(cli_args.baseline):
+        with open(cli_args.baseline) as f:
+            baseline = json.load(f)
+        if {key: baseline.get(key) for key in scale} != scale:
+            print(f"The baseline in {cli_args.baseline} has another scale, it is not compared")
+            baseline = {'stages': {}}
+    regressions = compare(results, baseline.get('stages', {}), cli_args.threshold, cli_args.min_seconds)
+
+    if cli_args.save_baseline:
+        with open(cli_args.baseline, 'w') as f:
+            json.dump({**scale, 'stages': results}, f, indent=1)
+        print(f"Baseline saved to {cli_args.baseline}")
+    if regressions:
+        print(f"Throughput regression above {cli_args.threshold:.0%} in: {', '.join(regressions)}")
+        sys.exit(1)
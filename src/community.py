@@ -1,71 +1,159 @@
-import pandas as pd
-import geopandas as gpd
-import networkx as nx
+import os
+import random
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
 import igraph as ig
+import leidenalg
+from concurrent.futures import ProcessPoolExecutor
 
-from networkx.algorithms import community
+from src.cube import load_cube
+from src.dimensions import ALL
+from src.instrument import instrumented, stage
 
 
-df = pd.read_parquet('data/agg_data/graph.parquet')
-df = df[['CD_MUN_MOV','CD_MUN_RES','HOSPITALIZACOES','DIAG_PRINC']]
-# df = df[df['CD_MUN_MOV'] != df['CD_MUN_RES']]
-df = df.groupby(['CD_MUN_MOV','CD_MUN_RES','DIAG_PRINC']).agg({'HOSPITALIZACOES':'sum'}).reset_index()
-df.head()
-
-communities_df = []
-for diag in df['DIAG_PRINC'].unique():
-    df_diag = df[df['DIAG_PRINC']==diag].drop('DIAG_PRINC',axis=1)
-    
-    edges = [(df_diag.iloc[i]['CD_MUN_MOV'], df_diag.iloc[i]['CD_MUN_RES']) for i in range(len(df_diag))]
-    weights = df_diag['HOSPITALIZACOES'].tolist()
-    g_ig = ig.Graph.TupleList(edges, directed=True)
-    g_ig.es['weight'] = weights
+def build_graph(mov: np.ndarray, res: np.ndarray, weights: np.ndarray) -> tuple[ig.Graph, np.ndarray]:
+    """Build a directed weighted graph (hospital -> residence) from integer arrays of CD_MUN codes.
 
-    # Apply Leiden algorithm
-    communities = g_ig.community_infomap(edge_weights='weight', vertex_weights=None)
+    Args:
+        mov (np.ndarray): The CD_MUN of the hospital municipality of each edge.
+        res (np.ndarray): The CD_MUN of the residence municipality of each edge.
+        weights (np.ndarray): The number of hospitalizations of each edge.
 
-    print(f"{diag}.\n Number of communities found: {len(communities)}")
-    
-    membership = communities.membership
-    
-    community_df = pd.DataFrame({
-    'municipality': [g_ig.vs[i]['name'] for i in range(len(g_ig.vs))],
-    'community_id': membership
+    Returns:
+        tuple[ig.Graph, np.ndarray]: The graph and the CD_MUN of each of its vertices.
+    """
+    codes, vertex_ids = np.unique(np.concatenate([mov, res]), return_inverse=True)
+    edges = np.column_stack([vertex_ids[:len(mov)], vertex_ids[len(mov):]])
+    g_ig = ig.Graph(n=len(codes), edges=edges, directed=True)
+    g_ig.es['weight'] = weights
+    return g_ig, codes
+
+
+def initial_membership(codes: np.ndarray, warm_start: tuple[np.ndarray, np.ndarray]) -> list[int]:
+    """ Get the initial membership of the vertices from a previous partition.
+
+    Args:
+        codes (np.ndarray): The CD_MUN of each vertex.
+        warm_start (tuple[np.ndarray, np.ndarray]): The CD_MUN and community id of each municipality of the previous partition.
+
+    Returns:
+        list[int]: The community of each vertex, with a new singleton community for municipalities not in the previous partition.
+    """
+    previous = pd.Series(warm_start[1], index=warm_start[0])
+    membership = pd.Series(codes).map(previous).values
+    missing = np.isnan(membership)
+    membership[missing] = np.nanmax(membership, initial=-1) + 1 + np.arange(missing.sum())
+    return np.unique(membership, return_inverse=True)[1].tolist()
+
+
+@instrumented('community.detect', rows_in=lambda args: len(args[2]))
+def detect_communities(args) -> pd.DataFrame:
+    """ Detect the communities of the graph of a diagnosis and year.
+
+    Args:
+        args (tuple): The diagnosis, the year, the mov, res and weights arrays of the edges, the engine
+            ('leiden' or 'infomap'), the random seed and the previous partition to start from, or None.
+
+    Returns:
+        pd.DataFrame: The community of each municipality of the graph.
+    """
+    diag, year, mov, res, weights, engine, seed, warm_start = args
+    g_ig, codes = build_graph(mov, res, weights)
+
+    if engine == 'leiden':
+        membership = initial_membership(codes, warm_start) if warm_start is not None else None
+        communities = leidenalg.find_partition(g_ig, leidenalg.ModularityVertexPartition, weights='weight',
+                                               initial_membership=membership, n_iterations=-1, seed=seed)
+    elif engine == 'infomap':
+        # igraph draws its random numbers from the random module
+        random.seed(seed)
+        communities = g_ig.community_infomap(edge_weights='weight', vertex_weights=None)
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    print(f"{diag} ({year}).\n Number of communities found: {len(communities)}")
+
+    return pd.DataFrame({
+        'municipality': codes,
+        'community_id': communities.membership,
+        'DIAG_PRINC': diag,
+        'ANO_CMPT': year,
     })
-    
-    community_df['DIAG_PRINC'] = diag
-    
-    communities_df.append(community_df)
-    
-df = df.groupby(['CD_MUN_MOV','CD_MUN_RES']).agg({'HOSPITALIZACOES':'sum'}).reset_index()
-
-edges = [(df.iloc[i]['CD_MUN_MOV'], df.iloc[i]['CD_MUN_RES']) for i in range(len(df))]
-weights = df['HOSPITALIZACOES'].tolist()
-g_ig = ig.Graph.TupleList(edges, directed=True)
-g_ig.es['weight'] = weights
-
-# Apply Leiden algorithm
-communities = g_ig.community_infomap(edge_weights='weight', vertex_weights=None)
-
-print(f"Todos.\n Number of communities found: {len(communities)}")
-
-membership = communities.membership
-
-community_df = pd.DataFrame({
-'municipality': [g_ig.vs[i]['name'] for i in range(len(g_ig.vs))],
-'community_id': membership
-})
-
-community_df['DIAG_PRINC'] = 'Todos'
-
-communities_df.append(community_df)
-    
-communities_df = pd.concat(communities_df)
-
-diags = pd.read_csv('docs/static/data/diag.csv',index_col='DIAG_PRINC')
 
-communities_df['DIAG_PRINC'] = communities_df['DIAG_PRINC'].map(diags['COD'])
 
-communities_df.to_csv('docs/static/data/communities.csv')
\ No newline at end of file
+def load_warm_start(paths: list[str]) -> dict:
+    """ Load previous partitions, as saved in communities.csv or communities_by_year.csv.
+
+    Args:
+        paths (list[str]): The paths to the previous partitions.
+
+    Returns:
+        dict: The CD_MUN and community id arrays of each (diagnosis, year) code.
+    """
+    warm_start = dict()
+    for path in paths:
+        previous = pd.read_csv(path)
+        if 'ANO_CMPT' not in previous:
+            previous['ANO_CMPT'] = ALL
+        for (diag, year), group in previous.groupby(['DIAG_PRINC', 'ANO_CMPT']):
+            warm_start[(int(diag), int(year))] = (group['municipality'].values, group['community_id'].values)
+    return warm_start
+
+
+def find_warm_start(warm_start: dict, diag: int, year: int):
+    """ Find the previous partition of a diagnosis and year, or of the year before if there is none. """
+    if (diag, year) in warm_start:
+        return warm_start[(diag, year)]
+    if year != ALL:
+        return warm_start.get((diag, year - 1))
+    return None
+
+
+def graph_tasks() -> list[tuple]:
+    """ List a graph for each diagnosis and year, including all diagnoses and all years, largest first.
+
+        The edges of each graph are read from the marginals of the cube.
+
+    Returns:
+        list[tuple]: The diagnosis, year and mov, res and weights arrays of each graph.
+    """
+    tasks = []
+    for keys in [['DIAG_PRINC', 'ANO_CMPT'], ['DIAG_PRINC'], ['ANO_CMPT'], []]:
+        df = load_cube(['CD_MUN_RES', 'CD_MUN_MOV'] + keys)
+        df = df.assign(**{key: ALL for key in ['DIAG_PRINC', 'ANO_CMPT'] if key not in keys})
+        tasks += [(diag, year, group['CD_MUN_MOV'].values, group['CD_MUN_RES'].values, group['HOSPITALIZACOES'].values)
+                  for (diag, year), group in df.groupby(['DIAG_PRINC', 'ANO_CMPT'])]
+    return sorted(tasks, key=lambda task: len(task[2]), reverse=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['infomap', 'leiden'], default='infomap',
+                        help='Community detection algorithm.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, so runs are reproducible.')
+    parser.add_argument('--warm-start', nargs='*', default=[],
+                        help='Previous communities.csv / communities_by_year.csv to refine with the leiden engine. '
+                             'Years without a previous partition start from the one of the year before.')
+    cli_args = parser.parse_args()
+    if cli_args.warm_start and cli_args.engine != 'leiden':
+        parser.error('--warm-start requires --engine leiden')
+
+    # Read before they are overwritten, as the previous run is usually the warm start
+    warm_start = load_warm_start(cli_args.warm_start)
+
+    tasks = [task + (cli_args.engine, cli_args.seed, find_warm_start(warm_start, task[0], task[1]))
+             for task in graph_tasks()]
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        communities_df = list(executor.map(detect_communities, tasks))
+    communities_df = pd.concat(communities_df)
+
+    communities_df = communities_df.sort_values(['DIAG_PRINC', 'ANO_CMPT'], kind='stable')
+
+    # The site loads the communities over all years, the ones by year are saved separately
+    all_years = communities_df['ANO_CMPT'] == ALL
+    with stage('export.communities', rows_out=len(communities_df)):
+        communities_df[all_years].drop('ANO_CMPT', axis=1).to_csv('docs/static/data/communities.csv')
+        communities_df[~all_years].to_csv('docs/static/data/communities_by_year.csv', index=False)
@@ -1,12 +1,43 @@
-import geopandas as gpd
+import os
+import argparse
+import shapely
 
-# Define the input shapefile path and the desired output GeoJSON path
-shapefile_path = 'data/BR_Municipios_2024/BR_Municipios_2024.shp'
+from src.geometry import load_municipalities
+from src.instrument import stage
+
+# Tolerance (degrees) of each level of detail of the TopoJSON files
+TOPOJSON_LEVELS = {'low': 0.05, 'medium': 0.01, 'high': 0.002}
+TOPOJSON_QUANTIZATION = 1e5
+
+
+def write_topojson(gdf, path: str):
+    """ Write municipalities as quantized TopoJSON, with CD_MUN as their only property.
+
+        The topojson package is an optional dependency, only needed for these files.
+    """
+    try:
+        import topojson
+    except ImportError as e:
+        raise ImportError("The TopoJSON output requires the topojson package (pip install topojson).") from e
+
+    topology = topojson.Topology(gdf[['CD_MUN', 'geometry']], prequantize=TOPOJSON_QUANTIZATION,
+                                 object_name='municipalities')
+    with open(path, 'w') as f:
+        f.write(topology.to_json())
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tiles', action='store_true',
+                    help='Also write one TopoJSON tile per state, at the highest level of detail.')
+cli_args = parser.parse_args()
+
+# Define the desired output GeoJSON path
 geojson_path = 'docs/static/data/brazil_municipalities.geojson'
+topojson_dir = 'docs/static/data/topojson'
 
-# Read the shapefile into a GeoDataFrame
-print("Reading shapefile...")
-gdf = gpd.read_file(shapefile_path)
+# Load the municipalities from the geometry cache (built from the shapefile on the first run)
+print("Loading municipalities...")
+gdf = load_municipalities()
 
 # --- Optional but Recommended: Reproject to WGS84 ---
 # Web maps (Google Maps, Leaflet, D3) use the EPSG:4326 coordinate system.
@@ -15,15 +46,37 @@ if gdf.crs != 'EPSG:4326':
     print(f"Original CRS is {gdf.crs}. Converting to EPSG:4326...")
     gdf = gdf.to_crs('EPSG:4326')
 
+# --- Multi-resolution TopoJSON ---
+# Shared borders are simplified once for both neighbours (coverage simplification), so the levels
+# of detail have no gaps or overlaps, and TopoJSON stores each shared border only once.
+os.makedirs(topojson_dir, exist_ok=True)
+for level, tolerance in TOPOJSON_LEVELS.items():
+    print(f"Writing TopoJSON level '{level}' (tolerance {tolerance})...")
+    with stage(f'export.topojson_{level}', rows_out=len(gdf)):
+        lod = gdf[['CD_MUN', 'CD_UF', 'geometry']].copy()
+        lod['geometry'] = shapely.coverage_simplify(lod['geometry'].values, tolerance=tolerance)
+        write_topojson(lod, f'{topojson_dir}/municipalities_{level}.topojson')
+    if level == 'high':
+        high = lod
+
+# Tiles are cut from the 'high' level of detail, so their borders match the national layer
+if cli_args.tiles:
+    os.makedirs(f'{topojson_dir}/tiles', exist_ok=True)
+    with stage('export.topojson_tiles', rows_out=len(high)):
+        for uf_code, tile in high.groupby('CD_UF'):
+            print(f"Writing tile of state {uf_code}...")
+            write_topojson(tile, f'{topojson_dir}/tiles/{uf_code}.topojson')
+
 # --- Optional but Recommended: Simplify Geometries ---
 # GeoJSON files for all Brazilian municipalities can be very large.
 # Simplifying the polygons will significantly reduce file size and improve map performance.
 # The tolerance value is in the same units as the CRS (degrees for EPSG:4326).
 # Adjust the tolerance (e.g., 0.001) for more or less detail.
-print("Simplifying geometries...")
-gdf['geometry'] = gdf['geometry'].simplify(tolerance=0.01)
+with stage('export.geojson', rows_out=len(gdf)):
+    print("Simplifying geometries...")
+    gdf['geometry'] = gdf['geometry'].simplify(tolerance=0.01)
 
 
-# Save the GeoDataFrame to a GeoJSON file
-print(f"Saving to {geojson_path}...")
-gdf.to_file(geojson_path, driver='GeoJSON')
\ No newline at end of file
+    # Save the GeoDataFrame to a GeoJSON file
+    print(f"Saving to {geojson_path}...")
+    gdf.to_file(geojson_path, driver='GeoJSON')
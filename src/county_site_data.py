@@ -1,32 +1,44 @@
 import pandas as pd
 import numpy as np
 
+from src.cube import load_cube
+from src.dimensions import ALL, diag_labels
+from src.distances import lookup_distances
+from src.geometry import load_centroids, load_municipality_attributes
+from src.instrument import stage
+
 if __name__ == "__main__":
-    df = pd.read_parquet('data/agg_data/graph.parquet')
-    
-    df['HOSPxDIST'] = df['HOSPITALIZACOES'] * df['DISTANCE']
-    df['SAME_MUN'] = (df['CD_MUN_RES'] == df['CD_MUN_MOV']) * df['HOSPITALIZACOES']
-    distdf = df.groupby(['CD_MUN_RES','ANO_CMPT','DIAG_PRINC']).agg({'HOSPITALIZACOES':'sum','HOSPxDIST':'sum', 'SAME_MUN':'sum'})
+    distdf = load_cube(['CD_MUN_RES','ANO_CMPT','DIAG_PRINC'])
+
     distdf['DISTANCE'] = distdf['HOSPxDIST'] / distdf['HOSPITALIZACOES']
     distdf['PCT_SAME_MUN'] = distdf['SAME_MUN'] / distdf['HOSPITALIZACOES']
     distdf = distdf.drop('HOSPxDIST',axis =1)
     distdf = distdf.drop('SAME_MUN', axis= 1)
     distdf['DISTANCE'] = distdf['DISTANCE'].round(3)
     distdf['PCT_SAME_MUN'] = distdf['PCT_SAME_MUN'].round(5)
-    distdf = distdf.reset_index(drop=False)
-    
-    diag = pd.DataFrame(distdf['DIAG_PRINC'].unique()).rename({0:'DIAG_PRINC'},axis=1) \
-    .reset_index(drop=False).set_index('DIAG_PRINC').rename({'index':'COD'},axis=1) + 1
-    
-    distdf['DIAG_PRINC'] = distdf['DIAG_PRINC'].map(diag['COD'])
-    
-    county_info =  df.groupby(['CD_MUN_RES']).agg({'MUNIC_RES':'first','UF_RES':'first','RES_LAT':'first','RES_LON':'first'}) \
-    .rename({'CD_MUN_RES':'CD_MUN','UF_RES':'UF','RES_LAT':'LAT','RES_LON':'LON'},axis=1).rename_axis('CD_MUN')
-    
-    distdf.to_csv('docs/static/data/counties.csv',index=False)
-    diag = pd.concat([pd.DataFrame({'DIAG_PRINC':['Todos'],'COD':[0]}).set_index('DIAG_PRINC',drop=True), diag],axis=0)
-    diag.to_csv('docs/static/data/diag.csv')
-    county_info.to_csv('docs/static/data/county_info.csv')
-    
-    graph_site = df.groupby(['CD_MUN_RES','CD_MUN_MOV']).agg({'HOSPITALIZACOES':'sum','DISTANCE':'first'})
-    graph_site.to_csv('docs/static/data/graph.csv')
\ No newline at end of file
+    distdf = distdf.sort_values(['CD_MUN_RES','ANO_CMPT','DIAG_PRINC'], ignore_index=True)
+
+    # The diagnoses are already coded as in diag.csv, their names are only attached for the export
+    labels = diag_labels()
+    codes = np.concatenate([[ALL], np.sort(distdf['DIAG_PRINC'].unique())])
+    diag = pd.DataFrame({'DIAG_PRINC': labels[codes].values, 'COD': codes}).set_index('DIAG_PRINC')
+
+    municipalities = load_municipality_attributes().set_index('CD_MUN')
+    centroids = load_centroids().astype(np.float32)
+    county_info = pd.DataFrame(index=pd.Index(distdf['CD_MUN_RES'].unique(), name='CD_MUN'))
+    county_info['MUNIC_RES'] = municipalities['NM_MUN'] + ' - ' + municipalities['NM_UF']
+    county_info['UF'] = municipalities['NM_UF']
+    county_info['LAT'] = centroids['LAT']
+    county_info['LON'] = centroids['LON']
+
+    with stage('export.counties', rows_out=len(distdf) + len(county_info)):
+        distdf.to_csv('docs/static/data/counties.csv',index=False)
+        diag.to_csv('docs/static/data/diag.csv')
+        county_info.to_csv('docs/static/data/county_info.csv')
+
+    with stage('export.graph_csv') as record:
+        graph_site = load_cube(['CD_MUN_RES','CD_MUN_MOV']).set_index(['CD_MUN_RES','CD_MUN_MOV']).sort_index()
+        graph_site['DISTANCE'] = lookup_distances(graph_site.index.get_level_values('CD_MUN_RES'),
+                                                  graph_site.index.get_level_values('CD_MUN_MOV'))
+        graph_site[['HOSPITALIZACOES','DISTANCE']].to_csv('docs/static/data/graph.csv')
+        record['rows_out'] = len(graph_site)
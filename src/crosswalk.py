@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.geometry import MUNICIPALITIES_PATH, is_stale as geometry_is_stale, load_municipality_attributes
+from src.transform_data import get_state_name, get_city_name
+
+
+CROSSWALK_PATH = 'data/agg_data/crosswalk.parquet'
+SIH_MUNICIPALITIES_PATH = 'data/aux_data/MUNIC_BR.csv'
+
+
+def is_stale(path: str=CROSSWALK_PATH) -> bool:
+    """Check if the cached crosswalk is missing or older than the SIH municipality table or the geometry cache."""
+    if not os.path.exists(path) or geometry_is_stale(MUNICIPALITIES_PATH):
+        return True
+    return os.path.getmtime(path) < max(os.path.getmtime(SIH_MUNICIPALITIES_PATH), os.path.getmtime(MUNICIPALITIES_PATH))
+
+
+def build_crosswalk() -> pd.DataFrame:
+    """Build the crosswalk from the 6-digit SIH municipality codes to the 7-digit IBGE CD_MUN.
+
+        Codes are first matched on the IBGE code without its check digit, which also covers
+        municipalities renamed since the SIH table was written. The remaining codes (districts of
+        São Paulo, Rio de Janeiro and Brasília, and codes replaced after municipalities were split
+        or merged) are matched on their "City - State" name. Codes that match neither, such as the
+        "Município ignorado" ones, are left out of the crosswalk.
+
+    Returns:
+        pd.DataFrame: The crosswalk, with columns SIH_CODE, CD_MUN and MATCH ('code' or 'name').
+    """
+    mapa = load_municipality_attributes()
+    mapa['MUN'] = mapa['NM_MUN'].astype(str) + ' - ' + mapa['NM_UF']
+
+    # Lagoa dos Patos and Lagoa Mirim share the 6-digit prefix 430000 and are not municipalities
+    prefix = mapa['CD_MUN'] // 10
+    by_code = pd.Series(mapa['CD_MUN'].values, index=prefix)
+    by_code = by_code[~by_code.index.duplicated(keep=False)]
+    by_name = mapa.set_index('MUN')['CD_MUN']
+
+    sih = pd.read_csv(SIH_MUNICIPALITIES_PATH, sep=';')['cod'].drop_duplicates()
+    crosswalk = pd.DataFrame({'SIH_CODE': sih.values})
+    crosswalk['CD_MUN'] = crosswalk['SIH_CODE'].map(by_code)
+    crosswalk['MATCH'] = np.where(crosswalk['CD_MUN'].notna(), 'code', 'name')
+
+    unmatched = crosswalk['CD_MUN'].isna()
+    names = get_city_name(crosswalk.loc[unmatched, 'SIH_CODE']).astype(str) + ' - ' \
+        + get_state_name(crosswalk.loc[unmatched, 'SIH_CODE'])
+    crosswalk.loc[unmatched, 'CD_MUN'] = names.map(by_name)
+
+    crosswalk = crosswalk.dropna(subset=['CD_MUN'])
+    return crosswalk.astype({'SIH_CODE': np.int32, 'CD_MUN': np.int32, 'MATCH': 'string'}).reset_index(drop=True)
+
+
+def load_crosswalk(rebuild: bool=False) -> pd.DataFrame:
+    """Load the cached crosswalk, building it first if it is missing or stale.
+
+    Args:
+        rebuild (bool, optional): Rebuild the cached crosswalk even if it exists. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The crosswalk, with columns SIH_CODE, CD_MUN and MATCH.
+    """
+    if rebuild or is_stale():
+        os.makedirs(os.path.dirname(CROSSWALK_PATH), exist_ok=True)
+        build_crosswalk().to_parquet(CROSSWALK_PATH, index=False)
+    return pd.read_parquet(CROSSWALK_PATH)
+
+
+def sih_to_cd_mun(codes: pd.Series) -> pd.Series:
+    """Convert SIH municipality codes to IBGE CD_MUN, with NaN for codes without a municipality."""
+    crosswalk = load_crosswalk().set_index('SIH_CODE')['CD_MUN']
+    return codes.astype(np.int32).map(crosswalk)
+
+
+if __name__ == "__main__":
+
+    crosswalk = load_crosswalk(rebuild=True)
+    print(crosswalk['MATCH'].value_counts())
+    print(f"Crosswalk with {len(crosswalk)} codes saved to {CROSSWALK_PATH}")
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+CUBE_PATH = 'data/agg_data/cube.parquet'
+# Flows of the SIH codes that are not in the crosswalk, by the UF of their codes, written by src.agg_county_level
+UNRESOLVED_PATH = 'data/agg_data/graph_unresolved.parquet'
+DIMENSIONS = ['CD_MUN_RES', 'CD_MUN_MOV', 'UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC']
+MEASURES = ['HOSPITALIZACOES', 'HOSPxDIST', 'SAME_MUN']
+
+# The marginals needed by the site exports, the flow store and the community detection
+GROUPING_SETS = [
+    ['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT', 'DIAG_PRINC'],
+    ['CD_MUN_RES', 'CD_MUN_MOV', 'DIAG_PRINC'],
+    ['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT'],
+    ['CD_MUN_RES', 'CD_MUN_MOV'],
+    ['CD_MUN_RES', 'ANO_CMPT', 'DIAG_PRINC'],
+    ['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC'],
+]
+
+
+def grouping_id(keys: list[str]) -> int:
+    """Get the id of a grouping set, with the bits of the aggregated dimensions set, as SQL GROUPING()."""
+    return sum(1 << (len(DIMENSIONS) - 1 - i) for i, dimension in enumerate(DIMENSIONS) if dimension not in keys)
+
+
+def build_cube(df: pd.DataFrame, unresolved: pd.DataFrame=None) -> pd.DataFrame:
+    """ Compute all the marginals of the hospitalizations in a single pass, with GROUPING SETS semantics.
+
+        The data is reduced once to the finest grain and every grouping set is rolled up from it.
+        Dimensions aggregated away in a grouping set are null, and GROUPING_ID identifies the set.
+        The flows without a municipality only count in the grouping sets without municipalities,
+        with no distance (their HOSPxDIST is 0).
+
+    Args:
+        df (pd.DataFrame): The data of graph.parquet.
+        unresolved (pd.DataFrame, optional): The data of graph_unresolved.parquet. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The cube, with the DIMENSIONS, the MEASURES (hospitalizations, hospitalizations
+            times distance and hospitalizations in the municipality of residence) and GROUPING_ID.
+    """
+    df = df[['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT', 'DIAG_PRINC', 'HOSPITALIZACOES', 'DISTANCE']]
+    hospitalizations = df['HOSPITALIZACOES'].astype(np.int64)
+    base = df[['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT', 'DIAG_PRINC']].assign(
+        HOSPITALIZACOES=hospitalizations,
+        HOSPxDIST=hospitalizations * df['DISTANCE'].astype(np.float64),
+        SAME_MUN=(df['CD_MUN_RES'] == df['CD_MUN_MOV']) * hospitalizations,
+    )
+    base = base.groupby(['CD_MUN_RES', 'CD_MUN_MOV', 'ANO_CMPT', 'DIAG_PRINC'], as_index=False)[MEASURES].sum()
+    base['UF_RES'] = (base['CD_MUN_RES'] // 100000).astype(np.int8)
+    base['UF_MOV'] = (base['CD_MUN_MOV'] // 100000).astype(np.int8)
+    if unresolved is not None:
+        hospitalizations = unresolved['HOSPITALIZACOES'].astype(np.int64)
+        unresolved = unresolved[['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC']].assign(
+            HOSPITALIZACOES=hospitalizations,
+            HOSPxDIST=0.0,
+            SAME_MUN=unresolved['SAME_MUN'] * hospitalizations,
+        )
+
+    cube = []
+    for keys in GROUPING_SETS:
+        part = base
+        if unresolved is not None and not {'CD_MUN_RES', 'CD_MUN_MOV'} & set(keys):
+            part = pd.concat([base[unresolved.columns], unresolved], ignore_index=True)
+        part = part.groupby(keys, as_index=False)[MEASURES].sum()
+        part['GROUPING_ID'] = grouping_id(keys)
+        cube.append(part)
+    cube = pd.concat(cube, ignore_index=True)
+    return cube[DIMENSIONS + MEASURES + ['GROUPING_ID']].astype({
+        'CD_MUN_RES': 'Int32', 'CD_MUN_MOV': 'Int32', 'UF_RES': 'Int8', 'UF_MOV': 'Int8',
+        'ANO_CMPT': 'Int16', 'DIAG_PRINC': 'Int16', 'GROUPING_ID': np.int8,
+    })
+
+
+def load_cube(keys: list[str]) -> pd.DataFrame:
+    """ Load a marginal of the cube, reading only the row groups of its grouping set.
+
+    Args:
+        keys (list[str]): The dimensions of the grouping set, which must be one of GROUPING_SETS.
+
+    Returns:
+        pd.DataFrame: The keys and the MEASURES of the marginal.
+    """
+    if sorted(keys) not in [sorted(grouping_set) for grouping_set in GROUPING_SETS]:
+        raise KeyError(f"The cube has no grouping set {keys}")
+    df = pd.read_parquet(CUBE_PATH, columns=keys + MEASURES, filters=[('GROUPING_ID', '==', grouping_id(keys))])
+    return df.astype({key: {'CD_MUN_RES': np.int32, 'CD_MUN_MOV': np.int32, 'UF_RES': np.int8,
+                            'UF_MOV': np.int8}.get(key, np.int16) for key in keys})
+
+
+if __name__ == "__main__":
+
+    df = pd.read_parquet('data/agg_data/graph.parquet')
+    cube = build_cube(df, pd.read_parquet(UNRESOLVED_PATH) if os.path.exists(UNRESOLVED_PATH) else None)
+    print(cube.groupby('GROUPING_ID').size())
+    cube.to_parquet(CUBE_PATH, index=False, row_group_size=1_000_000)
+    print(f"Cube saved to {CUBE_PATH}")
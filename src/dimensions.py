@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+CID10_PATH = 'data/CID10/cid10_capitulos.csv'
+DIMENSIONS_DIR = 'data/agg_data/dimensions'
+CID_PATH = f'{DIMENSIONS_DIR}/cid.parquet'
+DIAG_PATH = f'{DIMENSIONS_DIR}/diag.parquet'
+
+# Code of all diagnoses, and of all years, in the marginals, and its label on the site
+ALL = 0
+ALL_LABEL = 'Todos'
+
+# Roman numerals of the CID-10 chapters in the order of their COD in the published diag.csv, which the
+# site and previous communities.csv files (used as warm starts) rely on. It is the order of the names,
+# except for XXI and XX, which were published as 20 and 21.
+CHAPTER_ORDER = ['I', 'II', 'III', 'IV', 'IX', 'V', 'VI', 'VII', 'VIII', 'X', 'XI', 'XII', 'XIII', 'XIV',
+                 'XIX', 'XV', 'XVI', 'XVII', 'XVIII', 'XXI', 'XX', 'XXII']
+
+
+def is_stale(path: str) -> bool:
+    """Check if a dimension table is missing or older than the CID-10 chapters table or the chapter codes."""
+    return not os.path.exists(path) or \
+        os.path.getmtime(path) < max(os.path.getmtime(CID10_PATH), os.path.getmtime(__file__))
+
+
+def build_dimensions():
+    """ Build the dimension tables of the diagnoses from the CID-10 chapters table.
+
+        diag.parquet codes the chapters 1, 2, ... following CHAPTER_ORDER, as the COD of diag.csv,
+        and cid.parquet codes the CID-10 categories 0, 1, ... in the order of their codes, each with
+        the code of its chapter. Municipalities and UFs are already coded by their IBGE codes, with
+        their names in the geometry cache.
+    """
+    os.makedirs(DIMENSIONS_DIR, exist_ok=True)
+    groups = pd.read_csv(CID10_PATH, sep=';').drop_duplicates('codigo').sort_values('codigo', ignore_index=True)
+
+    names = pd.Series(groups['descricao_breve'].unique())
+    numerals = names.str.split('.').str[0]
+    unknown = sorted(set(numerals) - set(CHAPTER_ORDER))
+    if unknown:
+        raise ValueError(f"Chapters without a code in CHAPTER_ORDER: {unknown}")
+    codes = pd.Series(np.arange(1, len(CHAPTER_ORDER) + 1, dtype=np.int16), index=CHAPTER_ORDER)
+    chapters = pd.DataFrame({'DIAG_PRINC': codes[numerals].values, 'NAME': names.values}).sort_values('DIAG_PRINC')
+    chapters.to_parquet(DIAG_PATH, index=False)
+    pd.DataFrame({'CID_CODE': np.arange(len(groups), dtype=np.int16), 'CID': groups['codigo'].values,
+                  'DIAG_PRINC': groups['descricao_breve'].map(chapters.set_index('NAME')['DIAG_PRINC']).values}) \
+        .to_parquet(CID_PATH, index=False)
+
+
+def load_cid() -> pd.DataFrame:
+    """Load the CID-10 categories (CID_CODE, CID and DIAG_PRINC), building the dimension tables if needed."""
+    if is_stale(CID_PATH):
+        build_dimensions()
+    return pd.read_parquet(CID_PATH)
+
+
+def load_diag() -> pd.DataFrame:
+    """Load the CID-10 chapters (DIAG_PRINC and NAME), building the dimension tables if needed."""
+    if is_stale(DIAG_PATH):
+        build_dimensions()
+    return pd.read_parquet(DIAG_PATH)
+
+
+def encode_cid(categories: pd.Series) -> np.ndarray:
+    """Code CID-10 categories (3 characters) as their CID_CODE, with -1 for the ones not in the chapters table."""
+    return pd.Categorical(categories, categories=load_cid()['CID']).codes.astype(np.int16)
+
+
+def cid_to_diag(codes: np.ndarray) -> np.ndarray:
+    """Map CID_CODEs to the code of their chapter, keeping -1 for unknown categories."""
+    chapters = np.append(load_cid()['DIAG_PRINC'].values, np.int16(-1))
+    return chapters[codes]
+
+
+def diag_labels() -> pd.Series:
+    """Get the name of each chapter by its code, with 'Todos' for ALL."""
+    names = load_diag().set_index('DIAG_PRINC')['NAME']
+    return pd.concat([pd.Series([ALL_LABEL], index=pd.Index([ALL], dtype=names.index.dtype)), names])
+
+
+if __name__ == "__main__":
+
+    build_dimensions()
+    print(f"Dimension tables saved to {DIMENSIONS_DIR}")
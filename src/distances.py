@@ -0,0 +1,110 @@
+import os
+import numpy as np
+from functools import lru_cache
+
+from src.geometry import CENTROIDS_PATH, GEO_DIR, build_geometry_cache, is_stale, load_centroids
+
+
+DISTANCES_PATH = f'{GEO_DIR}/distances.npy'
+DISTANCE_INDEX_PATH = f'{GEO_DIR}/distance_index.npy'
+BLOCK_SIZE = 256
+
+
+def haversine_vectorized(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points 
+    on the earth (specified in decimal degrees) using vectorized operations
+    """
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    
+    # Haversine formula
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    
+    # Radius of earth in kilometers
+    r = 6371
+    
+    return c * r
+
+
+def build_distance_matrix(path: str=DISTANCES_PATH, index_path: str=DISTANCE_INDEX_PATH):
+    """Build the dense float32 matrix of distances (km) between all municipality centroids.
+
+        The matrix is written as a .npy file, so it can be memory mapped, and row i corresponds
+        to the i-th code of the index, which is the sorted array of CD_MUN of the centroid cache.
+        It is computed in blocks of rows, so building it needs little more memory than the matrix.
+
+    Args:
+        path (str, optional): The path of the matrix. Defaults to DISTANCES_PATH.
+        index_path (str, optional): The path of the index. Defaults to DISTANCE_INDEX_PATH.
+    """
+    centroids = load_centroids()
+    index = centroids.index.values.astype(np.int32)
+    lat, lon = centroids['LAT'].values, centroids['LON'].values
+
+    matrix = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=(len(index), len(index)))
+    for start in range(0, len(index), BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, len(index))
+        matrix[start:end] = haversine_vectorized(lat[start:end, None], lon[start:end, None], lat[None, :], lon[None, :])
+    matrix.flush()
+    del matrix
+
+    np.save(index_path, index)
+    os.replace(path + '.tmp', path)
+
+
+@lru_cache(maxsize=1)
+def load_distance_matrix(path: str=DISTANCES_PATH, index_path: str=DISTANCE_INDEX_PATH) -> tuple[np.ndarray, np.ndarray]:
+    """Memory map the distance matrix, building it first if it is missing or older than the centroids.
+
+    Args:
+        path (str, optional): The path of the matrix. Defaults to DISTANCES_PATH.
+        index_path (str, optional): The path of the index. Defaults to DISTANCE_INDEX_PATH.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (read only) distance matrix and the sorted CD_MUN of its rows and columns.
+    """
+    # A missing or stale centroid cache is rebuilt first, so the matrix is compared with the current one
+    if is_stale(CENTROIDS_PATH):
+        build_geometry_cache()
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(CENTROIDS_PATH):
+        build_distance_matrix(path, index_path)
+    return np.load(path, mmap_mode='r'), np.load(index_path)
+
+
+def code_to_row(codes, index: np.ndarray) -> np.ndarray:
+    """Convert CD_MUN codes to their row in the distance matrix, with -1 for unknown codes."""
+    codes = np.asarray(codes, dtype=np.int64)
+    rows = np.searchsorted(index, codes)
+    rows[rows == len(index)] = 0
+    return np.where(index[rows] == codes, rows, -1)
+
+
+def lookup_distances(res_codes, mov_codes, path: str=DISTANCES_PATH, index_path: str=DISTANCE_INDEX_PATH) -> np.ndarray:
+    """Gather the distances (km) between arrays of residence and hospital CD_MUN codes.
+
+    Args:
+        res_codes (array-like): The CD_MUN of the residence municipalities.
+        mov_codes (array-like): The CD_MUN of the hospital municipalities, with the same length.
+        path (str, optional): The path of the matrix. Defaults to DISTANCES_PATH.
+        index_path (str, optional): The path of the index. Defaults to DISTANCE_INDEX_PATH.
+
+    Returns:
+        np.ndarray: The float32 distances, NaN where a code is not in the matrix.
+    """
+    matrix, index = load_distance_matrix(path, index_path)
+    res_rows, mov_rows = code_to_row(res_codes, index), code_to_row(mov_codes, index)
+    distances = matrix[res_rows, mov_rows]
+    distances[(res_rows < 0) | (mov_rows < 0)] = np.nan
+    return distances
+
+
+if __name__ == "__main__":
+
+    build_distance_matrix()
+    matrix, index = load_distance_matrix()
+    print(f"Distance matrix of {len(index)} municipalities saved to {DISTANCES_PATH}")
@@ -0,0 +1,164 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import svds
+from functools import lru_cache
+
+from src.cube import load_cube
+from src.dimensions import ALL
+from src.geometry import load_centroids
+from src.instrument import instrumented, stage
+
+
+FLOWS_DIR = 'data/agg_data/flows'
+FLOW_INDEX_PATH = f'{FLOWS_DIR}/index.npy'
+FLOW_SLICES_PATH = f'{FLOWS_DIR}/slices.csv'
+METRICS_PATH = f'{FLOWS_DIR}/metrics.parquet'
+
+
+def flow_matrix(res: np.ndarray, mov: np.ndarray, weights: np.ndarray, index: np.ndarray) -> sp.csr_matrix:
+    """Build the residence -> hospital flow matrix, with rows and columns following the municipality index.
+
+    Args:
+        res (np.ndarray): The CD_MUN of the residence municipality of each flow.
+        mov (np.ndarray): The CD_MUN of the hospital municipality of each flow.
+        weights (np.ndarray): The number of hospitalizations of each flow.
+        index (np.ndarray): The sorted CD_MUN of the rows and columns.
+
+    Returns:
+        sp.csr_matrix: The flow matrix, summing repeated flows.
+    """
+    rows, cols = np.searchsorted(index, res), np.searchsorted(index, mov)
+    flows = sp.coo_matrix((weights.astype(np.float64), (rows, cols)), shape=(len(index), len(index)))
+    return flows.tocsr()
+
+
+@instrumented('flows.store')
+def build_flow_store():
+    """ Save the flow matrix of every diagnosis and year, including all diagnoses and all years.
+
+        The flows are read from the marginals of the cube. Each slice is a CSR matrix saved as .npz
+        in data/agg_data/flows, listed in slices.csv, and all of them share the same municipality
+        index (index.npy).
+    """
+    os.makedirs(FLOWS_DIR, exist_ok=True)
+    index = load_centroids().index.values.astype(np.int32)
+    np.save(FLOW_INDEX_PATH, index)
+
+    slices = []
+    for keys in [['DIAG_PRINC', 'ANO_CMPT'], ['DIAG_PRINC'], ['ANO_CMPT'], []]:
+        df = load_cube(['CD_MUN_RES', 'CD_MUN_MOV'] + keys)
+        df = df[df['CD_MUN_RES'].isin(index) & df['CD_MUN_MOV'].isin(index)]
+        df = df.assign(**{key: ALL for key in ['DIAG_PRINC', 'ANO_CMPT'] if key not in keys})
+        for (diag, year), group in df.groupby(['DIAG_PRINC', 'ANO_CMPT']):
+            file = f'{len(slices):04d}.npz'
+            flows = flow_matrix(group['CD_MUN_RES'].values, group['CD_MUN_MOV'].values,
+                                group['HOSPITALIZACOES'].values, index)
+            sp.save_npz(os.path.join(FLOWS_DIR, file), flows)
+            slices.append({'DIAG_PRINC': diag, 'ANO_CMPT': year, 'FILE': file})
+    pd.DataFrame(slices).to_csv(FLOW_SLICES_PATH, index=False)
+    load_flows.cache_clear()
+
+
+def load_flow_index() -> np.ndarray:
+    """Load the sorted CD_MUN of the rows and columns of the flow matrices."""
+    return np.load(FLOW_INDEX_PATH)
+
+
+def load_flow_slices() -> pd.DataFrame:
+    """Load the list of saved flow matrices, by DIAG_PRINC and ANO_CMPT codes."""
+    return pd.read_csv(FLOW_SLICES_PATH, dtype={'DIAG_PRINC': np.int16, 'ANO_CMPT': np.int16})
+
+
+@lru_cache(maxsize=64)
+def load_flows(diag: int=ALL, year: int=ALL) -> sp.csr_matrix:
+    """Load the residence -> hospital flow matrix of a diagnosis and year codes (ALL for all of them)."""
+    slices = load_flow_slices().set_index(['DIAG_PRINC', 'ANO_CMPT'])['FILE']
+    return sp.load_npz(os.path.join(FLOWS_DIR, slices.loc[(diag, year)])).tocsr()
+
+
+def pagerank(flows: sp.csr_matrix, alpha: float=0.85, tol: float=1e-10, max_iter: int=200) -> np.ndarray:
+    """ PageRank of the weighted flow graph by power iteration, with dangling municipalities linking to all of them. """
+    n = flows.shape[0]
+    out_strength = np.asarray(flows.sum(axis=1)).ravel()
+    dangling = out_strength == 0
+    inv_strength = np.divide(1., out_strength, out=np.zeros(n), where=~dangling)
+    transition_t = (sp.diags(inv_strength) @ flows).T.tocsr()
+
+    rank = np.full(n, 1. / n)
+    for _ in range(max_iter):
+        new_rank = alpha * (transition_t @ rank) + (alpha * rank[dangling].sum() + 1. - alpha) / n
+        converged = np.abs(new_rank - rank).sum() < tol
+        rank = new_rank
+        if converged:
+            break
+    return rank
+
+
+def hits(flows: sp.csr_matrix) -> tuple[np.ndarray, np.ndarray]:
+    """ Hub and authority scores of the weighted flow graph, the leading singular vectors of the flow matrix. """
+    n = flows.shape[0]
+    if flows.nnz == 0:
+        return np.zeros(n), np.zeros(n)
+    hubs, _, authorities = svds(flows, k=1)
+    hubs, authorities = np.abs(hubs[:, 0]), np.abs(authorities[0])
+    return hubs / hubs.sum(), authorities / authorities.sum()
+
+
+def top_k_share(flows: sp.csr_matrix, k: int) -> np.ndarray:
+    """ Share of the flow of each municipality going to its k largest destinations. """
+    flows = flows.tocsr()
+    rows = np.repeat(np.arange(flows.shape[0]), np.diff(flows.indptr))
+    # Sort each row by decreasing flow and find the rank of each entry inside its row
+    order = np.lexsort((-flows.data, rows))
+    rank = np.arange(flows.nnz) - flows.indptr[rows[order]]
+    top = np.bincount(rows[order], weights=np.where(rank < k, flows.data[order], 0.), minlength=flows.shape[0])
+    total = np.asarray(flows.sum(axis=1)).ravel()
+    return np.divide(top, total, out=np.full(flows.shape[0], np.nan), where=total > 0)
+
+
+def network_metrics(flows: sp.csr_matrix, index: np.ndarray, k: int=3) -> pd.DataFrame:
+    """ Compute the network metrics of every municipality of a flow matrix.
+
+    Args:
+        flows (sp.csr_matrix): The residence -> hospital flow matrix.
+        index (np.ndarray): The CD_MUN of the rows and columns.
+        k (int, optional): Number of destinations of the top-k share. Defaults to 3.
+
+    Returns:
+        pd.DataFrame: OUT_STRENGTH (hospitalizations of residents), IN_STRENGTH (hospitalizations treated),
+            SELF_CONTAINMENT (share of residents treated in the municipality), PAGERANK, HUB, AUTHORITY
+            and TOP_K_SHARE, indexed by CD_MUN, for the municipalities with any flow.
+    """
+    out_strength = np.asarray(flows.sum(axis=1)).ravel()
+    in_strength = np.asarray(flows.sum(axis=0)).ravel()
+    hubs, authorities = hits(flows)
+    metrics = pd.DataFrame({
+        'OUT_STRENGTH': out_strength,
+        'IN_STRENGTH': in_strength,
+        'SELF_CONTAINMENT': np.divide(flows.diagonal(), out_strength, out=np.full(len(index), np.nan), where=out_strength > 0),
+        'PAGERANK': pagerank(flows),
+        'HUB': hubs,
+        'AUTHORITY': authorities,
+        'TOP_K_SHARE': top_k_share(flows, k),
+    }, index=pd.Index(index, name='CD_MUN'))
+    return metrics[(out_strength > 0) | (in_strength > 0)]
+
+
+if __name__ == "__main__":
+
+    build_flow_store()
+
+    index = load_flow_index()
+    metrics = []
+    with stage('flows.metrics') as record:
+        for _, row in load_flow_slices().iterrows():
+            slice_metrics = network_metrics(load_flows(row['DIAG_PRINC'], row['ANO_CMPT']), index).reset_index()
+            slice_metrics.insert(1, 'DIAG_PRINC', row['DIAG_PRINC'])
+            slice_metrics.insert(2, 'ANO_CMPT', row['ANO_CMPT'])
+            metrics.append(slice_metrics)
+        metrics = pd.concat(metrics, ignore_index=True)
+        metrics.to_parquet(METRICS_PATH, index=False)
+        record['rows_out'] = len(metrics)
+    print(f"Flow matrices and network metrics saved to {FLOWS_DIR}")
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+
+SHAPEFILE_PATH = 'data/BR_Municipios_2024/BR_Municipios_2024.shp'
+GEO_DIR = 'data/agg_data/geo'
+MUNICIPALITIES_PATH = f'{GEO_DIR}/municipalities.parquet'
+CENTROIDS_PATH = f'{GEO_DIR}/centroids.npz'
+STATES_PATH = f'{GEO_DIR}/states.parquet'
+
+
+def is_stale(path: str) -> bool:
+    """Check if a cached file is missing or older than the municipalities shapefile."""
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(SHAPEFILE_PATH)
+
+
+def build_geometry_cache():
+    """Build the geometry cache from the local shapefile, without any network access.
+
+        Writes the municipalities as GeoParquet, their centroids as compact arrays keyed by
+        CD_MUN and the states, dissolved from the municipalities, as GeoParquet.
+    """
+    os.makedirs(GEO_DIR, exist_ok=True)
+
+    print("Reading shapefile...")
+    mapa = gpd.read_file(SHAPEFILE_PATH)
+    mapa['CD_MUN'] = mapa['CD_MUN'].astype(np.int32)
+    mapa = mapa.sort_values('CD_MUN', ignore_index=True)
+    mapa.to_parquet(MUNICIPALITIES_PATH, index=False)
+
+    # Same centroids as computed before on the shapefile CRS (SIRGAS 2000, in degrees)
+    centroids = mapa.geometry.centroid
+    np.savez(CENTROIDS_PATH, cd_mun=mapa['CD_MUN'].values, lat=centroids.y.values, lon=centroids.x.values)
+
+    print("Dissolving states...")
+    states = mapa[['CD_UF', 'SIGLA_UF', 'NM_UF', 'CD_REGIA', 'NM_REGIA', 'geometry']].dissolve(
+        by=['CD_UF', 'SIGLA_UF', 'NM_UF', 'CD_REGIA', 'NM_REGIA'], as_index=False)
+    states = states.rename(columns={'CD_UF': 'code_state', 'SIGLA_UF': 'abbrev_state', 'NM_UF': 'name_state',
+                                    'CD_REGIA': 'code_region', 'NM_REGIA': 'name_region'})
+    states = states.astype({'code_state': np.int8, 'code_region': np.int8})
+
+    # Centroids on an equal area projection, as done before for the state level graph
+    centroids = states.to_crs('+proj=cea').centroid.to_crs(states.crs)
+    states['centroid_lat'] = centroids.y
+    states['centroid_lon'] = centroids.x
+    states.sort_values('code_state', ignore_index=True).to_parquet(STATES_PATH, index=False)
+
+
+def load_municipalities() -> gpd.GeoDataFrame:
+    """Load the municipality polygons, building the geometry cache if needed."""
+    if is_stale(MUNICIPALITIES_PATH):
+        build_geometry_cache()
+    return gpd.read_parquet(MUNICIPALITIES_PATH)
+
+
+def load_municipality_attributes(columns: list[str]=['CD_MUN', 'NM_MUN', 'CD_UF', 'NM_UF', 'SIGLA_UF']) -> pd.DataFrame:
+    """Load the municipality attributes without their geometries, building the geometry cache if needed."""
+    if is_stale(MUNICIPALITIES_PATH):
+        build_geometry_cache()
+    return pd.read_parquet(MUNICIPALITIES_PATH, columns=columns)
+
+
+def load_centroids() -> pd.DataFrame:
+    """Load the municipality centroids, building the geometry cache if needed.
+
+    Returns:
+        pd.DataFrame: The centroids, with columns LAT and LON, indexed by CD_MUN.
+    """
+    if is_stale(CENTROIDS_PATH):
+        build_geometry_cache()
+    with np.load(CENTROIDS_PATH) as centroids:
+        return pd.DataFrame({'LAT': centroids['lat'], 'LON': centroids['lon']},
+                            index=pd.Index(centroids['cd_mun'], name='CD_MUN'))
+
+
+def load_states() -> gpd.GeoDataFrame:
+    """Load the state polygons, with the same columns as geobr.read_state and their centroids, building the geometry cache if needed."""
+    if is_stale(STATES_PATH):
+        build_geometry_cache()
+    return gpd.read_parquet(STATES_PATH)
+
+
+if __name__ == "__main__":
+
+    build_geometry_cache()
+    print(f"Geometry cache saved to {GEO_DIR}")
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import runpy
+import resource
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+
+
+REPORTS_DIR = 'data/agg_data/reports'
+# Directory where the records of the current run are spooled, inherited by the pool workers
+INSTRUMENT_DIR_ENV = 'INSTRUMENT_DIR'
+# Name of the stage to profile and profiler to use ('cprofile' or 'pyinstrument')
+PROFILE_ENV = 'INSTRUMENT_PROFILE'
+PROFILER_ENV = 'INSTRUMENT_PROFILER'
+
+spool_lock = threading.Lock()
+# Running RSS peak of each stage open in this process, as a nested stage resets the high-water mark
+open_peaks = []
+peaks_lock = threading.Lock()
+
+
+def read_io() -> dict:
+    """ Bytes read and written by the process so far, from /proc/self/io (zero where it is not available).
+
+        These count every read and write call, including the ones served from the page cache.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read': int(counters['rchar']), 'written': int(counters['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return {'read': 0, 'written': 0}
+
+
+def cpu_seconds(usage: resource.struct_rusage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+def read_peak_rss() -> int:
+    """The RSS high-water mark of the process (VmHWM) in bytes, or None where /proc/self/status is not available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the RSS high-water mark of the process to its current RSS. Returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def start_peak() -> list:
+    """ Start measuring the RSS peak of a stage, returning its running peak.
+
+        The high-water mark is reset, after folding it into the peaks of the stages that are
+        already open, so they still account for the memory used before the new stage started.
+    """
+    with peaks_lock:
+        hwm = read_peak_rss()
+        if hwm is not None:
+            for peak in open_peaks:
+                peak[0] = max(peak[0], hwm)
+        peak = [None]
+        if hwm is not None and reset_peak_rss():
+            peak[0] = read_peak_rss()
+            open_peaks.append(peak)
+        return peak
+
+
+def end_peak(peak: list) -> int:
+    """Stop measuring the RSS peak of a stage, returning it in bytes, or None if it could not be measured."""
+    with peaks_lock:
+        if peak[0] is None:
+            return None
+        hwm = read_peak_rss()
+        for other in open_peaks:
+            other[0] = max(other[0], hwm)
+        open_peaks.remove(peak)
+        return peak[0]
+
+
+def start_profiler(name: str):
+    """Start the profiler selected by INSTRUMENT_PROFILER if this is the stage named by INSTRUMENT_PROFILE."""
+    if os.environ.get(PROFILE_ENV) != name:
+        return None
+    if os.environ.get(PROFILER_ENV, 'cprofile') == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError as e:
+            raise ImportError("The pyinstrument profiler requires the pyinstrument package (pip install pyinstrument).") from e
+        profiler = Profiler()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+    if hasattr(profiler, 'enable'):
+        profiler.enable()
+    else:
+        profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, path: str) -> str:
+    """Stop a profiler and save its results next to path, as .prof (cProfile) or .html (pyinstrument)."""
+    if hasattr(profiler, 'dump_stats'):
+        profiler.disable()
+        profiler.dump_stats(path + '.prof')
+        return path + '.prof'
+    profiler.stop()
+    with open(path + '.html', 'w') as f:
+        f.write(profiler.output_html())
+    return path + '.html'
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """ Measure a stage of the pipeline, if instrumentation is enabled (INSTRUMENT_DIR is set).
+
+        The record holds the wall and CPU time of the stage, the CPU time of the child processes
+        that finished during it, the peak RSS of the process during the stage (from its high-water
+        mark, reset when the stage starts) and the bytes read and written. Where the high-water mark
+        cannot be reset, peak_rss_bytes is None and process_peak_rss_so_far_bytes holds the peak of
+        the process so far instead. children_peak_rss_so_far_bytes is the largest high-water mark of
+        the child processes finished so far, not only during the stage.
+        The caller can add fields to the record it yields, such as rows_in and rows_out. Records
+        are appended to a file per process in INSTRUMENT_DIR, so pool workers report their own.
+
+    Args:
+        name (str): The name of the stage.
+        **fields: Extra fields of the record.
+
+    Yields:
+        dict: The record of the stage, or an empty dict if instrumentation is disabled.
+    """
+    spool_dir = os.environ.get(INSTRUMENT_DIR_ENV)
+    if spool_dir is None:
+        yield {}
+        return
+
+    record = {'stage': name, 'pid': os.getpid(), 'ppid': os.getppid(), **fields}
+    profiler = start_profiler(name)
+    io_start = read_io()
+    self_start, children_start = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = start_peak()
+    record['start'] = time.time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        if not (isinstance(e, SystemExit) and e.code in (None, 0)):
+            record['error'] = repr(e)
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['peak_rss_bytes'] = end_peak(peak)
+        self_end, children_end = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_end = read_io()
+        record['cpu_seconds'] = cpu_seconds(self_end) - cpu_seconds(self_start)
+        record['children_cpu_seconds'] = cpu_seconds(children_end) - cpu_seconds(children_start)
+        # ru_maxrss is in KiB on Linux, and follows the resets of the high-water mark
+        if record['peak_rss_bytes'] is None:
+            record['process_peak_rss_so_far_bytes'] = self_end.ru_maxrss * 1024
+        record['children_peak_rss_so_far_bytes'] = children_end.ru_maxrss * 1024
+        record['bytes_read'] = io_end['read'] - io_start['read']
+        record['bytes_written'] = io_end['written'] - io_start['written']
+        if profiler is not None:
+            record['profile'] = stop_profiler(profiler, os.path.join(spool_dir, f'{name}.{os.getpid()}'))
+        with spool_lock, open(os.path.join(spool_dir, f'{os.getpid()}.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def instrumented(name: str=None, rows_in=None):
+    """ Decorator measuring every call of a function as a stage, with the length of its result as rows_out.
+
+    Args:
+        name (str, optional): The name of the stage. Defaults to the module and name of the function.
+        rows_in (callable, optional): Function of the arguments of the call giving its rows_in. Defaults to None.
+    """
+    def decorator(func):
+        stage_name = name or f'{func.__module__}.{func.__name__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                if record and rows_in is not None:
+                    record['rows_in'] = int(rows_in(*args, **kwargs))
+                result = func(*args, **kwargs)
+                if record and hasattr(result, '__len__'):
+                    record['rows_out'] = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def new_run_dir() -> str:
+    """Create the spool directory of a new run in REPORTS_DIR."""
+    run_dir = os.path.join(REPORTS_DIR, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+    os.makedirs(run_dir)
+    return run_dir
+
+
+def write_report(run_dir: str, **metadata) -> str:
+    """ Gather the records spooled in a run directory into a single JSON report, saved as <run_dir>.json.
+
+        The report has the records of every stage, ordered by start, and a summary by stage name
+        with the number of calls and their total wall and CPU time and largest peak RSS (None if
+        no call could measure it).
+
+    Returns:
+        str: The path of the report.
+    """
+    records = []
+    for file in sorted(os.listdir(run_dir)):
+        if file.endswith('.jsonl'):
+            with open(os.path.join(run_dir, file)) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['start'])
+
+    summary = dict()
+    for record in records:
+        total = summary.setdefault(record['stage'], {'calls': 0, 'wall_seconds': 0., 'cpu_seconds': 0.,
+                                                     'peak_rss_bytes': None, 'bytes_read': 0, 'bytes_written': 0})
+        total['calls'] += 1
+        for key in ['wall_seconds', 'cpu_seconds', 'bytes_read', 'bytes_written']:
+            total[key] += record[key]
+        if record['peak_rss_bytes'] is not None:
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'] or 0, record['peak_rss_bytes'])
+
+    path = run_dir.rstrip('/') + '.json'
+    with open(path, 'w') as f:
+        json.dump({'run': os.path.basename(run_dir.rstrip('/')), **metadata, 'summary': summary, 'stages': records}, f, indent=1)
+    return path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Run a module (as python -m) with instrumentation enabled and write the report of the run. '
+                    f'Set {PROFILE_ENV}=<stage> to profile a stage, with cProfile or, with {PROFILER_ENV}=pyinstrument, pyinstrument.')
+    parser.add_argument('--stage', default=None, help='Name of the stage of the whole module. Defaults to the module.')
+    parser.add_argument('module', help='Module to run, e.g. src.cube.')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the module.')
+    cli_args = parser.parse_args()
+
+    # Inside a run that is already instrumented (e.g. by the pipeline) the records join that run
+    own_run = INSTRUMENT_DIR_ENV not in os.environ
+    if own_run:
+        os.environ[INSTRUMENT_DIR_ENV] = new_run_dir()
+
+    sys.argv = [cli_args.module] + cli_args.args
+    try:
+        with stage(cli_args.stage or cli_args.module):
+            runpy.run_module(cli_args.module, run_name='__main__', alter_sys=True)
+    finally:
+        if own_run:
+            print(f"Report saved to {write_report(os.environ[INSTRUMENT_DIR_ENV], argv=sys.argv)}")
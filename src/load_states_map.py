@@ -1,20 +1,13 @@
-import geobr
-import geopandas as gpd
+from src.geometry import load_states
+from src.instrument import stage
 
-print("Fetching state boundaries...")
+print("Loading state boundaries...")
 
-states_gdf = geobr.read_state(year=2020)
+states_gdf = load_states().drop(columns=['centroid_lat', 'centroid_lon'])
 
-states_gdf.replace({'name_state': {
-    'Amazônas': 'Amazonas',
-    'Rio Grande Do Norte': 'Rio Grande do Norte',
-    'Rio Grande Do Sul': 'Rio Grande do Sul',
-    'Rio De Janeiro': 'Rio de Janeiro',
-    'Mato Grosso Do Sul': 'Mato Grosso do Sul',
-}}, inplace=True)
+with stage('export.states_map', rows_out=len(states_gdf)):
+    states_gdf['geometry'] = states_gdf['geometry'].simplify(tolerance=0.01)
 
-states_gdf['geometry'] = states_gdf['geometry'].simplify(tolerance=0.01)
-
-states_gdf.to_file('docs/static/data/brazil-states.geojson', driver='GeoJSON')
+    states_gdf.to_file('docs/static/data/brazil-states.geojson', driver='GeoJSON')
 
 print("'brazil-states.geojson' created successfully.")
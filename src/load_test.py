@@ -0,0 +1,79 @@
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from src.query_service import QueryStore
+
+
+def random_queries(store: QueryStore, n: int, seed: int) -> list[str]:
+    """ Draw a mix of flow, state matrix and community queries over the municipalities, diagnoses and years of the store. """
+    rng = np.random.default_rng(seed)
+    municipalities = store.municipalities
+    diags = [int(cod) for cod in store.labels['diags']]
+    years = store.labels['years']
+    queries = []
+    for _ in range(n):
+        mun, diag = int(rng.choice(municipalities)), int(rng.choice(diags))
+        first, last = sorted(int(year) for year in rng.choice(years, 2))
+        kind = rng.random()
+        if kind < 0.6:
+            queries.append(f'/flows?mun={mun}&diag={diag}&from={first}&to={last}')
+        elif kind < 0.7:
+            queries.append(f'/states?diag={diag}&from={first}&to={last}')
+        else:
+            queries.append(f'/community?mun={mun}&diag={diag}&year={rng.choice([0] + years)}')
+    return queries
+
+
+async def client(host: str, port: int, queries: list[str], latencies: list[tuple[str, float]]):
+    """ Send the queries one after the other over a keep-alive connection, timing each response. """
+    reader, writer = await asyncio.open_connection(host, port)
+    for query in queries:
+        start = time.perf_counter()
+        writer.write(f'GET {query} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+        await writer.drain()
+        length = 0
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append((query.split('?')[0], time.perf_counter() - start))
+    writer.close()
+
+
+async def run(host: str, port: int, queries: list[str], concurrency: int) -> tuple[list, float]:
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, queries[i::concurrency], latencies) for i in range(concurrency)])
+    return latencies, time.perf_counter() - start
+
+
+def report(latencies: list[tuple[str, float]], elapsed: float):
+    """ Print the p50 and p99 latencies, overall and by route, and the throughput. """
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} requests/s)")
+    routes = np.array([route for route, _ in latencies])
+    seconds = np.array([latency for _, latency in latencies])
+    for route in ['all'] + sorted(set(routes)):
+        route_seconds = seconds if route == 'all' else seconds[routes == route]
+        p50, p99 = np.percentile(route_seconds, [50, 99]) * 1000
+        print(f"{route:>12}: n={len(route_seconds):>6}  p50={p50:.2f}ms  p99={p99:.2f}ms")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Number of concurrent keep-alive connections.')
+    parser.add_argument('--distinct', type=int, default=None,
+                        help='Number of distinct queries drawn (repeated queries hit the LRU cache). '
+                             'Defaults to all requests being drawn independently.')
+    parser.add_argument('--seed', type=int, default=0)
+    cli_args = parser.parse_args()
+
+    queries = random_queries(QueryStore(), cli_args.distinct or cli_args.requests, cli_args.seed)
+    queries = [queries[i % len(queries)] for i in range(cli_args.requests)]
+    report(*asyncio.run(run(cli_args.host, cli_args.port, queries, cli_args.concurrency)))
@@ -0,0 +1,309 @@
+import os
+import ast
+import sys
+import json
+import shlex
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from src.instrument import INSTRUMENT_DIR_ENV, new_run_dir, write_report
+
+
+PIPELINE_STATE_PATH = 'data/agg_data/pipeline_state.json'
+GEO_DIR = 'data/agg_data/geo'
+DIMENSIONS_DIR = 'data/agg_data/dimensions'
+SITE_DIR = 'docs/static/data'
+PRINT_LOCK = threading.Lock()
+
+# Each stage runs `python -m <module> <args>`. A stage depends on the stages whose outputs are its
+# inputs, and it is skipped when its inputs, its code and its arguments are unchanged since its last run.
+STAGES = {
+    'geometry': {
+        'module': 'src.geometry',
+        'inputs': ['data/BR_Municipios_2024'],
+        'outputs': [f'{GEO_DIR}/municipalities.parquet', f'{GEO_DIR}/centroids.npz', f'{GEO_DIR}/states.parquet'],
+    },
+    'distances': {
+        'module': 'src.distances',
+        'inputs': [f'{GEO_DIR}/centroids.npz'],
+        'outputs': [f'{GEO_DIR}/distances.npy', f'{GEO_DIR}/distance_index.npy'],
+    },
+    'crosswalk': {
+        'module': 'src.crosswalk',
+        'inputs': ['data/aux_data/MUNIC_BR.csv', f'{GEO_DIR}/municipalities.parquet'],
+        'outputs': ['data/agg_data/crosswalk.parquet'],
+    },
+    'dimensions': {
+        'module': 'src.dimensions',
+        'inputs': ['data/CID10/cid10_capitulos.csv'],
+        'outputs': [f'{DIMENSIONS_DIR}/cid.parquet', f'{DIMENSIONS_DIR}/diag.parquet'],
+    },
+    'transform': {
+        'module': 'src.transform_data',
+        'inputs': ['data/SIH', f'{DIMENSIONS_DIR}/cid.parquet'],
+        'outputs': ['data/agg_data/hospitalizacoes.parquet'],
+    },
+    'county': {
+        'module': 'src.agg_county_level',
+        'inputs': ['data/agg_data/hospitalizacoes.parquet', f'{DIMENSIONS_DIR}/cid.parquet',
+                   'data/agg_data/crosswalk.parquet', f'{GEO_DIR}/distances.npy', f'{GEO_DIR}/states.parquet'],
+        'outputs': ['data/agg_data/graph.parquet', 'data/agg_data/graph_unresolved.parquet'],
+    },
+    'cube': {
+        'module': 'src.cube',
+        'inputs': ['data/agg_data/graph.parquet', 'data/agg_data/graph_unresolved.parquet'],
+        'outputs': ['data/agg_data/cube.parquet'],
+    },
+    'site_data': {
+        'module': 'src.county_site_data',
+        'inputs': ['data/agg_data/cube.parquet', f'{DIMENSIONS_DIR}/diag.parquet', f'{GEO_DIR}/municipalities.parquet',
+                   f'{GEO_DIR}/centroids.npz', f'{GEO_DIR}/distances.npy'],
+        'outputs': [f'{SITE_DIR}/counties.csv', f'{SITE_DIR}/diag.csv', f'{SITE_DIR}/county_info.csv',
+                    f'{SITE_DIR}/graph.csv'],
+    },
+    'community': {
+        'module': 'src.community',
+        'inputs': ['data/agg_data/cube.parquet'],
+        'outputs': [f'{SITE_DIR}/communities.csv', f'{SITE_DIR}/communities_by_year.csv'],
+    },
+    'state': {
+        'module': 'src.agg_state_level',
+        'inputs': ['data/agg_data/cube.parquet', f'{DIMENSIONS_DIR}/diag.parquet', f'{GEO_DIR}/states.parquet'],
+        'outputs': [f'{SITE_DIR}/states_graph.csv'],
+    },
+    'flows': {
+        'module': 'src.flows',
+        'inputs': ['data/agg_data/cube.parquet', f'{GEO_DIR}/centroids.npz'],
+        'outputs': ['data/agg_data/flows'],
+    },
+    'accessibility': {
+        'module': 'src.accessibility',
+        'inputs': ['data/agg_data/cube.parquet', f'{GEO_DIR}/centroids.npz'],
+        'outputs': ['data/agg_data/accessibility.parquet'],
+    },
+    'site_export': {
+        'module': 'src.site_export',
+        'inputs': ['data/agg_data/flows', f'{SITE_DIR}/communities.csv',
+                   f'{SITE_DIR}/communities_by_year.csv', f'{GEO_DIR}/distances.npy'],
+        'outputs': [f'{SITE_DIR}/shards'],
+    },
+    'municipalities_map': {
+        'module': 'src.convert_json',
+        'inputs': [f'{GEO_DIR}/municipalities.parquet'],
+        'outputs': [f'{SITE_DIR}/brazil_municipalities.geojson', f'{SITE_DIR}/topojson'],
+    },
+    'states_map': {
+        'module': 'src.load_states_map',
+        'inputs': [f'{GEO_DIR}/states.parquet'],
+        'outputs': [f'{SITE_DIR}/brazil-states.geojson'],
+    },
+}
+
+
+def module_sources(module: str) -> list[str]:
+    """Find the source file of a module and of every src module it imports, recursively."""
+    sources, pending = set(), [module]
+    while pending:
+        path = pending.pop().replace('.', '/') + '.py'
+        if path in sources or not os.path.exists(path):
+            continue
+        sources.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module and node.module.startswith('src.'):
+                pending.append(node.module)
+            elif isinstance(node, ast.Import):
+                pending.extend(alias.name for alias in node.names if alias.name.startswith('src.'))
+    return sorted(sources)
+
+
+def list_files(path: str) -> list[str]:
+    """List a file, or every file under a directory, sorted."""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+class FileHashes:
+    """ Content hashes of files, reused while the size and modification time of a file are unchanged. """
+
+    def __init__(self, cache: dict):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.cache[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def stage_key(self, stage: dict, args: list[str]) -> str:
+        """Hash the inputs, the code and the arguments of a stage. Missing inputs hash as missing."""
+        digest = hashlib.sha256(json.dumps([stage['module'], args]).encode())
+        for path in stage['inputs'] + module_sources(stage['module']):
+            for file in list_files(path) if os.path.exists(path) else []:
+                digest.update(f'{file}:{self.file_hash(file)}\n'.encode())
+            if not os.path.exists(path):
+                digest.update(f'{path}:missing\n'.encode())
+        return digest.hexdigest()
+
+
+def load_pipeline_state() -> dict:
+    if not os.path.exists(PIPELINE_STATE_PATH):
+        return {'files': {}, 'stages': {}}
+    with open(PIPELINE_STATE_PATH) as f:
+        return json.load(f)
+
+
+def save_pipeline_state(state: dict):
+    """Save the state atomically, so an interrupted run keeps the previous one."""
+    tmp_path = PIPELINE_STATE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, PIPELINE_STATE_PATH)
+
+
+def stage_dependencies(stages: dict) -> dict:
+    """Find the stages each stage depends on, the ones producing (a directory containing) any of its inputs."""
+    def produces(output: str, path: str) -> bool:
+        return path == output or path.startswith(output.rstrip('/') + '/')
+
+    return {name: {other for other, producer in stages.items() if other != name and any(
+                produces(output, path) for output in producer['outputs'] for path in stage['inputs'])}
+            for name, stage in stages.items()}
+
+
+def log_status(name: str, status: str):
+    with PRINT_LOCK:
+        print(f"[{name}] {status}", flush=True)
+
+
+def run_stage(name: str, args: list[str], hashes: FileHashes, done: dict, force: bool, dry_run: bool) -> tuple[str, str]:
+    """ Run a stage as `python -m`, unless it is up to date.
+
+    Returns:
+        tuple[str, str]: The status of the stage ('skipped', 'ran', 'would run' or 'failed') and its key.
+    """
+    stage = STAGES[name]
+    key = hashes.stage_key(stage, args)
+    if not force and done.get(name) == key and all(os.path.exists(path) for path in stage['outputs']):
+        return 'skipped', key
+    if dry_run:
+        return 'would run', key
+    with PRINT_LOCK:
+        print(f"[{name}] python -m {stage['module']} {shlex.join(args)}".rstrip(), flush=True)
+    # With a report, the stage runs under src.instrument, which records the whole stage too
+    command = ['-m', stage['module']] if INSTRUMENT_DIR_ENV not in os.environ \
+        else ['-m', 'src.instrument', '--stage', f'pipeline.{name}', stage['module']]
+    result = subprocess.run([sys.executable] + command + args)
+    if result.returncode != 0:
+        return 'failed', key
+    # The key is taken again, as a stage may rewrite its own inputs (e.g. lazily built caches)
+    return 'ran', hashes.stage_key(stage, args)
+
+
+def run_pipeline(targets: list[str], stage_args: dict, jobs: int, force: bool=False, dry_run: bool=False,
+                 no_deps: bool=False) -> dict:
+    """ Run the targets and the stages they depend on, with independent stages running concurrently.
+
+    Args:
+        targets (list[str]): The stages to run, all of them if empty.
+        stage_args (dict): The command line arguments of each stage.
+        jobs (int): Maximum number of stages running at the same time.
+        force (bool, optional): Run the stages even if up to date. Defaults to False.
+        dry_run (bool, optional): Only report which stages would run. Defaults to False.
+        no_deps (bool, optional): Run only the targets, not the stages they depend on. Defaults to False.
+
+    Returns:
+        dict: The status of each stage.
+    """
+    dependencies = stage_dependencies(STAGES)
+    selected, pending = set(), list(targets or STAGES)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            if not no_deps:
+                pending.extend(dependencies[name])
+
+    state = load_pipeline_state()
+    hashes = FileHashes(state['files'])
+    status = dict()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = dict()
+        while len(status) < len(selected):
+            for name in STAGES:
+                if name not in selected or name in status or name in running.values():
+                    continue
+                blocking = dependencies[name] & selected
+                if any(status.get(dependency) in ('failed', 'blocked') for dependency in blocking):
+                    status[name] = 'blocked'
+                    log_status(name, status[name])
+                # The inputs of a stage after an out of date stage are not known without running it
+                elif any(status.get(dependency) == 'would run' for dependency in blocking):
+                    status[name] = 'would run'
+                    log_status(name, status[name])
+                elif all(dependency in status for dependency in blocking) and len(running) < jobs:
+                    running[executor.submit(run_stage, name, stage_args.get(name, []), hashes, state['stages'],
+                                            force, dry_run)] = name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                status[name], key = future.result()
+                log_status(name, status[name])
+                if status[name] in ('ran', 'skipped'):
+                    state['stages'][name] = key
+                save_pipeline_state(state)
+    return status
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='*', default=[],
+                        help=f"Stages to run, with the stages they depend on ({', '.join(STAGES)}). Defaults to all of them.")
+    parser.add_argument('--args', action='append', default=[], metavar='STAGE=ARGS',
+                        help='Command line arguments of a stage, e.g. --args "community=--engine leiden". '
+                             'They are part of the hash, so changing them runs the stage again.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Maximum number of stages running at the same time.')
+    parser.add_argument('--force', action='store_true', help='Run the stages even if they are up to date.')
+    parser.add_argument('--dry-run', action='store_true', help='Only show which stages are out of date.')
+    parser.add_argument('--no-deps', action='store_true', help='Run only the targets, not the stages they depend on.')
+    parser.add_argument('--report', action='store_true',
+                        help='Record the time, CPU, memory and I/O of the stages and write a JSON report of the run.')
+    cli_args = parser.parse_args()
+
+    for name in cli_args.targets:
+        if name not in STAGES:
+            parser.error(f"Unknown stage {name}")
+    stage_args = dict()
+    for value in cli_args.args:
+        name, _, args = value.partition('=')
+        if name not in STAGES:
+            parser.error(f"Unknown stage {name}")
+        stage_args[name] = shlex.split(args)
+
+    os.makedirs(os.path.dirname(PIPELINE_STATE_PATH), exist_ok=True)
+    if cli_args.report:
+        os.environ[INSTRUMENT_DIR_ENV] = new_run_dir()
+    status = run_pipeline(cli_args.targets, stage_args, cli_args.jobs, cli_args.force, cli_args.dry_run,
+                          cli_args.no_deps)
+    if cli_args.report:
+        print(f"Report saved to {write_report(os.environ[INSTRUMENT_DIR_ENV], argv=sys.argv, status=status)}")
+    if any(value in ('failed', 'blocked') for value in status.values()):
+        sys.exit(1)
@@ -0,0 +1,215 @@
+import os
+import json
+import asyncio
+import argparse
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qsl
+
+from src.cube import load_cube
+from src.dimensions import ALL, diag_labels
+from src.geometry import load_states
+
+
+QUERY_DIR = 'data/agg_data/query'
+QUERY_LABELS_PATH = f'{QUERY_DIR}/labels.json'
+
+# Connections of each residence municipality, sorted by municipality, as in a CSR matrix
+EDGE_DTYPE = np.dtype([('mov', '<i4'), ('diag', '<i2'), ('year', '<i2'), ('hosp', '<i4'), ('dist', '<f4')])
+STATE_DTYPE = np.dtype([('res', '<i1'), ('mov', '<i1'), ('diag', '<i2'), ('year', '<i2'), ('hosp', '<i4')])
+# Partitions sorted by diagnosis, year (0 for all years) and municipality
+COMMUNITY_DTYPE = np.dtype([('mun', '<i4'), ('diag', '<i2'), ('year', '<i2'), ('community', '<i4')])
+
+
+def build_query_store():
+    """ Save the aggregated data as arrays that the query service memory-maps.
+
+        The connections of graph.parquet are sorted by residence municipality, with offsets.npy
+        giving the connections of each municipality of municipalities.npy, and the flows between
+        states are the ones of the cube. Diagnoses keep the codes
+        of graph.parquet, the COD of diag.csv, and the partitions are the ones of communities.csv and communities_by_year.csv.
+    """
+    os.makedirs(QUERY_DIR, exist_ok=True)
+    df = pd.read_parquet('data/agg_data/graph.parquet', columns=['CD_MUN_RES', 'CD_MUN_MOV', 'DIAG_PRINC', 'ANO_CMPT',
+                                                                'HOSPITALIZACOES', 'DISTANCE'])
+    municipalities = np.union1d(df['CD_MUN_RES'].unique(), df['CD_MUN_MOV'].unique()).astype(np.int32)
+    res = np.searchsorted(municipalities, df['CD_MUN_RES'].values)
+
+    edges = np.empty(len(df), dtype=EDGE_DTYPE)
+    edges['mov'] = np.searchsorted(municipalities, df['CD_MUN_MOV'].values)
+    edges['diag'] = df['DIAG_PRINC'].values
+    edges['year'] = df['ANO_CMPT'].values
+    edges['hosp'] = df['HOSPITALIZACOES'].values
+    edges['dist'] = df['DISTANCE'].values
+    order = np.lexsort((edges['year'], edges['diag'], edges['mov'], res))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(res, minlength=len(municipalities)))])
+
+    # The marginal of the cube, which also has the flows of the SIH codes without a municipality
+    states = load_cube(['UF_RES', 'UF_MOV', 'ANO_CMPT', 'DIAG_PRINC'])
+    state_array = np.empty(len(states), dtype=STATE_DTYPE)
+    state_array['res'] = states['UF_RES'].values
+    state_array['mov'] = states['UF_MOV'].values
+    state_array['diag'] = states['DIAG_PRINC'].values
+    state_array['year'] = states['ANO_CMPT'].values
+    state_array['hosp'] = states['HOSPITALIZACOES'].values
+
+    communities = pd.read_csv('docs/static/data/communities.csv', index_col=0).assign(ANO_CMPT=ALL)
+    if os.path.exists('docs/static/data/communities_by_year.csv'):
+        communities = pd.concat([communities, pd.read_csv('docs/static/data/communities_by_year.csv')])
+    communities = communities.sort_values(['DIAG_PRINC', 'ANO_CMPT', 'municipality'])
+    community_array = np.empty(len(communities), dtype=COMMUNITY_DTYPE)
+    community_array['mun'] = communities['municipality'].values
+    community_array['diag'] = communities['DIAG_PRINC'].values
+    community_array['year'] = communities['ANO_CMPT'].values
+    community_array['community'] = communities['community_id'].values
+    slice_keys = community_array['diag'].astype(np.int64) * 10000 + community_array['year']
+    keys, starts = np.unique(slice_keys, return_index=True)
+    ends = np.append(starts[1:], len(community_array))
+
+    np.save(f'{QUERY_DIR}/municipalities.npy', municipalities)
+    np.save(f'{QUERY_DIR}/offsets.npy', offsets.astype(np.int64))
+    np.save(f'{QUERY_DIR}/edges.npy', edges[order])
+    np.save(f'{QUERY_DIR}/states.npy', state_array)
+    np.save(f'{QUERY_DIR}/communities.npy', community_array)
+    uf_names = load_states().set_index('code_state')['abbrev_state']
+    diags = diag_labels()
+    with open(QUERY_LABELS_PATH, 'w') as f:
+        json.dump({
+            'diags': {int(cod): diags[cod] for cod in np.union1d([ALL], np.unique(edges['diag']))},
+            'years': sorted(int(year) for year in np.unique(edges['year'])),
+            'states': {int(code): uf_names.get(int(code), str(code)) for code in np.unique(state_array['res'])},
+            'community_slices': {f'{key // 10000}/{key % 10000}': [int(start), int(end)]
+                                 for key, start, end in zip(keys.tolist(), starts, ends)},
+        }, f, ensure_ascii=False)
+
+
+class QueryStore:
+    """ The arrays of the query store, memory-mapped, so only the pages touched by the queries are read. """
+
+    def __init__(self, path: str=QUERY_DIR):
+        self.municipalities = np.load(f'{path}/municipalities.npy')
+        self.offsets = np.load(f'{path}/offsets.npy', mmap_mode='r')
+        self.edges = np.load(f'{path}/edges.npy', mmap_mode='r')
+        self.states = np.load(f'{path}/states.npy', mmap_mode='r')
+        self.communities = np.load(f'{path}/communities.npy', mmap_mode='r')
+        with open(f'{path}/labels.json') as f:
+            self.labels = json.load(f)
+
+    def position(self, cd_mun: int) -> int:
+        i = np.searchsorted(self.municipalities, cd_mun)
+        if i == len(self.municipalities) or self.municipalities[i] != cd_mun:
+            raise LookupError(f"Unknown municipality {cd_mun}")
+        return int(i)
+
+    def year_mask(self, table: np.ndarray, diag: int, years: tuple[int, int]) -> np.ndarray:
+        mask = (table['year'] >= years[0]) & (table['year'] <= years[1])
+        return mask & (table['diag'] == diag) if diag != 0 else mask
+
+    def flows(self, cd_mun: int, diag: int=0, years: tuple[int, int]=(0, 9999)) -> dict:
+        """ Hospitalizations of the residents of a municipality by hospital municipality, largest first. """
+        i = self.position(cd_mun)
+        edges = self.edges[self.offsets[i]:self.offsets[i + 1]]
+        edges = edges[self.year_mask(edges, diag, years)]
+        mov, first, inverse = np.unique(edges['mov'], return_index=True, return_inverse=True)
+        hosp = np.bincount(inverse, weights=edges['hosp'], minlength=len(mov)).astype(np.int64)
+        order = np.argsort(-hosp, kind='stable')
+        return {
+            'CD_MUN_RES': cd_mun,
+            'HOSPITALIZACOES': int(hosp.sum()),
+            'flows': [{'CD_MUN_MOV': int(self.municipalities[mov[j]]), 'HOSPITALIZACOES': int(hosp[j]),
+                       'DISTANCE': round(float(edges['dist'][first[j]]), 3)} for j in order],
+        }
+
+    def state_matrix(self, diag: int=0, years: tuple[int, int]=(0, 9999)) -> dict:
+        """ Hospitalizations by state of residence (rows) and state of the hospital (columns). """
+        codes = np.array([int(code) for code in self.labels['states']])
+        states = self.states[self.year_mask(self.states, diag, years)]
+        matrix = np.zeros((len(codes), len(codes)), dtype=np.int64)
+        np.add.at(matrix, (np.searchsorted(codes, states['res']), np.searchsorted(codes, states['mov'])), states['hosp'])
+        return {'states': list(self.labels['states'].values()), 'matrix': matrix.tolist()}
+
+    def community(self, cd_mun: int, diag: int=0, year: int=0) -> dict:
+        """ Community of a municipality and its members, for a diagnosis and year (0 for all years). """
+        span = self.labels['community_slices'].get(f'{diag}/{year}')
+        if span is None:
+            raise LookupError(f"No communities for diagnosis {diag} and year {year}")
+        partition = self.communities[span[0]:span[1]]
+        i = np.searchsorted(partition['mun'], cd_mun)
+        if i == len(partition) or partition['mun'][i] != cd_mun:
+            raise LookupError(f"Municipality {cd_mun} has no community")
+        community_id = int(partition['community'][i])
+        members = partition['mun'][partition['community'] == community_id]
+        return {'CD_MUN': cd_mun, 'community_id': community_id, 'members': members.tolist()}
+
+
+def parse_years(params: dict) -> tuple[int, int]:
+    return int(params.get('from', 0)), int(params.get('to', 9999))
+
+
+ROUTES = {
+    '/flows': lambda store, p: store.flows(int(p['mun']), int(p.get('diag', 0)), parse_years(p)),
+    '/states': lambda store, p: store.state_matrix(int(p.get('diag', 0)), parse_years(p)),
+    '/community': lambda store, p: store.community(int(p['mun']), int(p.get('diag', 0)), int(p.get('year', 0))),
+}
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}
+
+
+def make_handler(store: QueryStore, cache_size: int):
+    """ Build the query function, with the responses of the most recent queries cached. """
+
+    @lru_cache(maxsize=cache_size)
+    def query(route: str, params: tuple) -> tuple[int, bytes]:
+        if route not in ROUTES:
+            return 404, json.dumps({'error': f"Unknown route {route}"}).encode()
+        try:
+            return 200, json.dumps(ROUTES[route](store, dict(params))).encode()
+        except LookupError as e:
+            return 404, json.dumps({'error': str(e)}).encode()
+        except (KeyError, ValueError) as e:
+            return 400, json.dumps({'error': f"Invalid parameter {e}"}).encode()
+
+    return query
+
+
+async def serve(store: QueryStore, host: str, port: int, cache_size: int):
+    """ Answer the queries over HTTP/1.1 with keep-alive, as JSON. """
+    query = make_handler(store, cache_size)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while request_line := await reader.readline():
+                # Skip the headers, the queries have no body
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                target = urlsplit(request_line.split()[1].decode())
+                status, body = query(target.path, tuple(sorted(parse_qsl(target.query))))
+                writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Serving {len(store.municipalities)} municipalities on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--build', action='store_true',
+                        help='Build the query store from graph.parquet and the communities before serving.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Number of responses kept in the LRU cache.')
+    cli_args = parser.parse_args()
+
+    if cli_args.build or not os.path.exists(QUERY_LABELS_PATH):
+        print(f"Building the query store in {QUERY_DIR}...")
+        build_query_store()
+    asyncio.run(serve(QueryStore(), cli_args.host, cli_args.port, cli_args.cache_size))
@@ -0,0 +1,81 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from src.dimensions import ALL, ALL_LABEL
+from src.distances import lookup_distances
+from src.flows import load_flow_index, load_flow_slices, load_flows
+from src.instrument import stage
+
+
+SHARDS_DIR = 'docs/static/data/shards'
+SHARDS_INDEX_PATH = f'{SHARDS_DIR}/index.json'
+
+
+def write_arrays(path: str, arrays: list[np.ndarray]):
+    """Write typed arrays back to back as little-endian binary, so the site can view them with no parsing."""
+    with open(path, 'wb') as f:
+        for array in arrays:
+            f.write(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+
+
+def year_label(year: int) -> str:
+    """Get the year of a shard as named by the site, 'Todos' for all years."""
+    return ALL_LABEL if year == ALL else str(year)
+
+
+def export_graph_shard(path: str, diag: int, year: int, index: np.ndarray):
+    """ Export the connections of a diagnosis and year, indexed by the residence municipality.
+
+        The shard holds, back to back, offsets (int32, one more than the municipalities), then
+        mov (int32 position of the hospital municipality in the index), hosp (int32) and dist
+        (float32, km) for each connection. The connections of the i-th municipality of the index
+        are the ones between offsets[i] and offsets[i + 1].
+    """
+    flows = load_flows(diag, year)
+    flows.sort_indices()
+    res = np.repeat(index, np.diff(flows.indptr))
+    distances = lookup_distances(res, index[flows.indices])
+    write_arrays(path, [flows.indptr.astype(np.int32), flows.indices.astype(np.int32),
+                        flows.data.astype(np.int32), distances.astype(np.float32)])
+
+
+def export_community_shard(path: str, communities: pd.DataFrame, index: np.ndarray):
+    """ Export a partition as the community id (int32) of each municipality of the index, -1 if it has none. """
+    membership = pd.Series(communities['community_id'].values, index=communities['municipality'].values)
+    write_arrays(path, [membership.reindex(index).fillna(-1).values.astype(np.int32)])
+
+
+if __name__ == "__main__":
+
+    os.makedirs(SHARDS_DIR, exist_ok=True)
+    index = load_flow_index()
+
+    graph_shards = dict()
+    with stage('export.graph_shards') as record:
+        for cod, year in load_flow_slices()[['DIAG_PRINC', 'ANO_CMPT']].itertuples(index=False):
+            file = f'graph_{cod}_{year_label(year)}.bin'
+            export_graph_shard(os.path.join(SHARDS_DIR, file), cod, year, index)
+            graph_shards[f'{cod}/{year_label(year)}'] = file
+        record['shards'] = len(graph_shards)
+
+    communities = pd.read_csv('docs/static/data/communities.csv').assign(ANO_CMPT=ALL)
+    if os.path.exists('docs/static/data/communities_by_year.csv'):
+        communities = pd.concat([communities, pd.read_csv('docs/static/data/communities_by_year.csv')])
+    community_shards = dict()
+    with stage('export.community_shards', rows_in=len(communities)) as record:
+        for (cod, year), group in communities.groupby(['DIAG_PRINC', 'ANO_CMPT']):
+            file = f'communities_{cod}_{year_label(year)}.bin'
+            export_community_shard(os.path.join(SHARDS_DIR, file), group, index)
+            community_shards[f'{cod}/{year_label(year)}'] = file
+        record['shards'] = len(community_shards)
+
+    with open(SHARDS_INDEX_PATH, 'w') as f:
+        json.dump({
+            'municipalities': index.tolist(),
+            'graph': {'layout': [['offsets', 'int32'], ['mov', 'int32'], ['hosp', 'int32'], ['dist', 'float32']],
+                      'shards': graph_shards},
+            'communities': {'layout': [['community_id', 'int32']], 'shards': community_shards},
+        }, f)
+    print(f"{len(graph_shards)} graph and {len(community_shards)} community shards saved to {SHARDS_DIR}")
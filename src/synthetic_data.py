@@ -0,0 +1,162 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.crosswalk import load_crosswalk
+
+
+SYNTHETIC_DIR = 'data/SIH_synthetic'
+BATCH_SIZE = 1_000_000
+# Changes whenever the same seed yields different data, so cached benchmark data is regenerated
+SYNTHETIC_VERSION = 3
+
+SCHEMA = pa.schema([
+    ('N_AIH', pa.string()), ('ANO_CMPT', pa.string()), ('MES_CMPT', pa.string()),
+    ('MUNIC_RES', pa.string()), ('MUNIC_MOV', pa.string()), ('DIAG_PRINC', pa.string()),
+    ('SEXO', pa.string()), ('IDADE', pa.int16()), ('DIAS_PERM', pa.int16()), ('VAL_TOT', pa.float64()),
+])
+
+
+def load_codes() -> tuple[pd.DataFrame, np.ndarray]:
+    """ Load the SIH municipality codes, with the abbreviation of their UF, and the CID-10 categories.
+
+        Only 6 digit codes that resolve to a municipality through the crosswalk are kept, so no rows
+        are drawn for the state-level (ending in 0000), "Município ignorado" (ending in 9999),
+        "transf." or "Ignorado ou exterior" (UF 00) codes, which the county aggregation drops.
+    """
+    ufs = pd.read_csv('data/aux_data/UF.csv', sep=';', dtype={'cod': str})
+    ufs = ufs[ufs['cod'] != '00']
+    municipalities = pd.read_csv('data/aux_data/MUNIC_BR.csv', sep=';', dtype={'cod': str})[['cod']].drop_duplicates()
+    municipalities['UF'] = municipalities['cod'].str[:2].map(ufs.set_index('cod')['value2'])
+    municipalities = municipalities[municipalities['UF'].notna() & municipalities['cod'].str.fullmatch(r'\d{6}')
+                                    & ~municipalities['cod'].str.endswith('0000')]
+    municipalities = municipalities[municipalities['cod'].astype(np.int32).isin(load_crosswalk()['SIH_CODE'])]
+    categories = pd.read_csv('data/CID10/cid10_capitulos.csv', sep=';')['codigo'].drop_duplicates().values
+    return municipalities.sort_values('cod', ignore_index=True), categories
+
+
+class FlowModel:
+    """ Random residence -> hospital flows, skewed like the real ones.
+
+        Residence municipalities have lognormal sizes. Most patients are treated where they live,
+        and the others go to hubs with Pareto distributed attractiveness, mostly in their own UF,
+        so a few hubs (like the capitals) receive most of the travelling patients. Diagnoses follow
+        a Zipf law over the CID-10 categories.
+    """
+
+    def __init__(self, municipalities: pd.DataFrame, categories: np.ndarray, rng: np.random.Generator,
+                 p_local: float=0.6, p_same_uf: float=0.8):
+        self.codes = municipalities['cod'].values
+        self.uf = municipalities['UF'].values
+        self.categories = categories
+        self.rng = rng
+        self.p_local, self.p_same_uf = p_local, p_same_uf
+
+        size = rng.lognormal(mean=0, sigma=1.5, size=len(self.codes))
+        self.res_p = size / size.sum()
+        attractiveness = size * rng.pareto(1.2, size=len(self.codes))
+        self.mov_p = attractiveness / attractiveness.sum()
+
+        # Cumulative attractiveness inside each UF, shifted by the position of the UF, so the hubs of
+        # the UF of many rows are drawn with a single searchsorted
+        self.uf_names, self.uf_index = np.unique(self.uf, return_inverse=True)
+        order = np.lexsort((np.arange(len(self.codes)), self.uf_index))
+        within = pd.Series(attractiveness[order]).groupby(self.uf_index[order]).transform(lambda a: a.cumsum() / a.sum())
+        self.uf_order = order
+        self.uf_cumulative = self.uf_index[order] + within.values
+
+        ranks = rng.permutation(len(categories)) + 1
+        self.diag_p = ranks ** -1.1 / (ranks ** -1.1).sum()
+
+        # String columns are built by taking from these arrays, in Arrow, much faster than numpy strings
+        self.code_array = pa.array(self.codes)
+        self.category_array = pa.array(categories.astype(str))
+
+    def sample(self, n: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Draw the positions of the residence and hospital municipalities and the diagnosis of n hospitalizations."""
+        res = self.rng.choice(len(self.codes), size=n, p=self.res_p)
+        uf_hub = self.uf_order[np.minimum(np.searchsorted(self.uf_cumulative, self.uf_index[res] + self.rng.random(n)),
+                                          len(self.codes) - 1)]
+        national_hub = self.rng.choice(len(self.codes), size=n, p=self.mov_p)
+        mov = np.where(self.rng.random(n) < self.p_local, res,
+                       np.where(self.rng.random(n) < self.p_same_uf, uf_hub, national_hub))
+        diag = self.rng.choice(len(self.categories), size=n, p=self.diag_p)
+        return res, mov, diag
+
+    def batch(self, n: int, year: int, month: int) -> tuple[pa.Table, np.ndarray]:
+        """Draw a table of n hospitalizations with the columns of the RD files, and the UF index of their hospitals."""
+        res, mov, diag = self.sample(n)
+        zeros = np.zeros(n, dtype=np.int8)
+        digits = pa.array(self.rng.integers(0, 10, size=n)).cast(pa.string())
+        table = pa.table({
+            'N_AIH': pa.array(self.rng.integers(10**12, 10**13, size=n)).cast(pa.string()),
+            'ANO_CMPT': pa.array([str(year)]).take(zeros),
+            'MES_CMPT': pa.array([f'{month:02d}']).take(zeros),
+            'MUNIC_RES': self.code_array.take(res),
+            'MUNIC_MOV': self.code_array.take(mov),
+            'DIAG_PRINC': pc.binary_join_element_wise(self.category_array.take(diag), digits, ''),
+            'SEXO': pa.array(['1', '3']).take((self.rng.random(n) < 0.5).astype(np.int8)),
+            'IDADE': self.rng.integers(0, 100, size=n).astype(np.int16),
+            'DIAS_PERM': self.rng.geometric(0.25, size=n).astype(np.int16),
+            'VAL_TOT': np.round(self.rng.lognormal(7, 1, size=n), 2),
+        }, schema=SCHEMA)
+        return table, self.uf_index[mov]
+
+
+def generate(rows: int, years: list[int], data_dir: str=SYNTHETIC_DIR, seed: int=0, batch_size: int=BATCH_SIZE) -> list[str]:
+    """ Write synthetic RD files, one per UF of the hospital and month, as RD<UF><YY><MM>.parquet.
+
+        Rows are generated and written in batches, so the memory used does not depend on the number of rows.
+
+    Args:
+        rows (int): Total number of hospitalizations, split evenly across the months.
+        years (list[int]): The years of the files.
+        data_dir (str, optional): The directory of the files. Defaults to SYNTHETIC_DIR.
+        seed (int, optional): Random seed. Defaults to 0.
+        batch_size (int, optional): Maximum number of rows generated at once. Defaults to BATCH_SIZE.
+
+    Returns:
+        list[str]: The paths of the files written.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    model = FlowModel(*load_codes(), rng=np.random.default_rng(seed))
+    periods = [(year, month) for year in years for month in range(1, 13)]
+    files = []
+    for i, (year, month) in enumerate(periods):
+        writers = dict()
+        remaining = rows // len(periods) + (i < rows % len(periods))
+        while remaining > 0:
+            batch, uf_mov = model.batch(min(batch_size, remaining), year, month)
+            remaining -= batch.num_rows
+            # Like the real files, each file has the hospitalizations in the hospitals of its UF
+            order = np.argsort(uf_mov, kind='stable')
+            ufs, starts = np.unique(uf_mov[order], return_index=True)
+            for uf, start, end in zip(ufs, starts, np.append(starts[1:], len(order))):
+                name = model.uf_names[uf]
+                if name not in writers:
+                    path = os.path.join(data_dir, f'RD{name}{year % 100:02d}{month:02d}.parquet')
+                    writers[name] = pq.ParquetWriter(path, SCHEMA)
+                    files.append(path)
+                writers[name].write_table(batch.take(order[start:end]))
+        for writer in writers.values():
+            writer.close()
+    return sorted(files)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Total number of hospitalizations.')
+    parser.add_argument('--years', type=int, nargs='+', default=[2024])
+    parser.add_argument('--data-dir', default=SYNTHETIC_DIR)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Maximum number of rows generated at once.')
+    cli_args = parser.parse_args()
+
+    files = generate(cli_args.rows, cli_args.years, cli_args.data_dir, cli_args.seed, cli_args.batch_size)
+    print(f"{cli_args.rows} hospitalizations written to {len(files)} files in {cli_args.data_dir}")
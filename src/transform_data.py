@@ -1,26 +1,81 @@
 import os
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import tempfile
 import pandas as pd
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor
+import pyarrow.acero as ac
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
+from src.dimensions import encode_cid
+from src.instrument import instrumented
 
-def process_file(files, principal_diagnosis):
+
+GROUP_COLUMNS = ['MUNIC_MOV', 'MUNIC_RES', 'DIAG_PRINC', 'ANO_CMPT']
+SIH_DIR = 'data/SIH'
+OUTPUT_PATH = 'data/agg_data/hospitalizacoes.parquet'
+MANIFEST_PATH = 'data/agg_data/manifest.json'
+PARTIALS_DIR = 'data/agg_data/partials'
+BATCH_SIZE = 1_000_000
+# Version of the schema of hospitalizacoes.parquet, recorded in the manifest so a change rebuilds it
+SCHEMA_VERSION = 2
+
+
+def scan_file(file: str, principal_diagnosis: list[str], batch_size: int=BATCH_SIZE) -> pd.Series:
+    """Count the hospitalizations of a parquet file, streaming it in record batches.
+
+        Only the grouping columns are read, the principal diagnosis filter is applied while scanning
+        and each batch is folded into a running group by, so the memory used depends on the batch
+        size and the number of groups, not on the size of the file.
+
+    Args:
+        file (str): The path to the parquet file (or dataset directory) to process.
+        principal_diagnosis (list[str]): List of principal diagnoses to filter by.
+        batch_size (int, optional): Maximum number of rows read at once. Defaults to BATCH_SIZE.
+
+    Returns:
+        pd.Series: The number of hospitalizations, indexed by GROUP_COLUMNS.
+    """
+    dataset = ds.dataset(file, format='parquet')
+    diagnosis = pc.utf8_slice_codeunits(ds.field('DIAG_PRINC'), 0, 3)
+    columns = {column: ds.field(column) for column in GROUP_COLUMNS}
+    columns['DIAG_PRINC'] = diagnosis
+    scan_filter = diagnosis.isin(principal_diagnosis) if len(principal_diagnosis) > 0 else None
+
+    counts = pd.Series(dtype=np.int64, index=pd.MultiIndex.from_tuples([], names=GROUP_COLUMNS))
+    for batch in dataset.to_batches(columns=columns, filter=scan_filter, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        batch_counts = batch.to_pandas().groupby(GROUP_COLUMNS).size()
+        counts = pd.concat([counts, batch_counts]).groupby(level=GROUP_COLUMNS).sum()
+    return counts
+
+
+def count_rows(files: list[str]) -> int:
+    """Count the rows of parquet files (or dataset directories) from their metadata."""
+    return sum(ds.dataset(file, format='parquet').count_rows() for file in files)
+
+
+@instrumented('transform.process_file', rows_in=lambda files, *args, **kwargs: count_rows(files))
+def process_file(files, principal_diagnosis, batch_size: int=BATCH_SIZE):
     """Process a list of files and filter by principal diagnosis.
 
     Args:
         files (list[str]): The paths to the parquet files to process.
         principal_diagnosis (list[str]): List of principal diagnoses to filter by.
+        batch_size (int, optional): Maximum number of rows read at once from each file. Defaults to BATCH_SIZE.
 
     Returns:
         pd.DataFrame: The processed DataFrame.
     """    
     dfs = []
     for file in files:
-        df = pd.read_parquet(file)
-        df['DIAG_PRINC'] = df['DIAG_PRINC'].str[:3]
-        if len(principal_diagnosis) > 0:
-            df = df[df['DIAG_PRINC'].isin(principal_diagnosis)]
-        df = df.groupby(['MUNIC_MOV', 'MUNIC_RES', 'DIAG_PRINC', 'ANO_CMPT']).size().reset_index(name='HOSPITALIZACOES')
+        df = scan_file(file, principal_diagnosis, batch_size).reset_index(name='HOSPITALIZACOES')
         dfs.append(df)
     if dfs:
         df = pd.concat(dfs, ignore_index=True)
@@ -33,12 +88,215 @@ def process_file(files, principal_diagnosis):
         return pd.DataFrame(columns=['MUNIC_MOV', 'MUNIC_RES', 'HOSPITALIZACOES', 'DIAG_PRINC', 'ANO_CMPT'])
     
 
+def file_uf(file: str) -> str:
+    """Get the UF of a SIH file, named RD<UF><YY><MM>.parquet."""
+    return os.path.basename(file)[2:4]
+
+
+def file_month(file: str) -> int:
+    """Get the month of a SIH file, named RD<UF><YY><MM>.parquet."""
+    return int(os.path.basename(file)[6:8])
+
+
+def list_files(uf: list[str]=[], months: list[int]=[], data_dir: str=SIH_DIR) -> list[str]:
+    """List the SIH parquet files matching the selected states (UFs) and months.
+
+    Args:
+        uf (list[str], optional): List of UFs (states) to filter the data, if non empty list. Defaults to [].
+        months (list[int], optional): List of months to filter the data, if non empty list. Defaults to [].
+        data_dir (str, optional): The directory of the SIH files. Defaults to SIH_DIR.
+
+    Returns:
+        list[str]: The paths of the matching files.
+    """
+    files = [os.path.join(data_dir, file) for file in os.listdir(data_dir) if file.endswith('.parquet')]
+    if len(uf) > 0:
+        files = [file for file in files if file_uf(file) in uf] # Filter by UF (state)
+    if len(months) > 0:
+        files = [file for file in files if file_month(file) in months] # Filter by month
+    if len(files) == 0:
+        raise ValueError("No files found matching the specified criteria.")
+    return sorted(files)
+
+
 def process_file_star(args):
     """ Helper function to unpack arguments for parallel processing. """
     return process_file(*args)
 
 
-def agg_num_hosp_city_hospital(uf: list[str]=[], months: list[int]=[], principal_diagnosis: list[str]=[], num_cpus: int=None):
+def process_file_to_path(args):
+    """ Helper function to aggregate a single file into a temporary parquet file.
+
+    Returns:
+        tuple[str, dict]: The path of the partial aggregate and the work done by the worker.
+    """
+    file, principal_diagnosis, tmp_dir = args
+    start = time.perf_counter()
+    df = process_file([file], principal_diagnosis)
+    path = os.path.join(tmp_dir, f'{uuid.uuid4().hex}.parquet')
+    df.to_parquet(path, index=False)
+    return path, {'pid': os.getpid(), 'seconds': time.perf_counter() - start,
+                  'bytes': file_signature(file)['size'], 'tasks': 1}
+
+
+def merge_paths(args):
+    """ Helper function to merge two partial aggregates in a worker, so they are never sent to the parent.
+
+    Returns:
+        tuple[str, dict]: The path of the merged aggregate and the work done by the worker.
+    """
+    path_a, path_b, tmp_dir = args
+    start = time.perf_counter()
+    df = pd.concat([pd.read_parquet(path_a), pd.read_parquet(path_b)], ignore_index=True)
+    df = df.groupby(GROUP_COLUMNS, as_index=False)['HOSPITALIZACOES'].sum()
+    path = os.path.join(tmp_dir, f'{uuid.uuid4().hex}.parquet')
+    df.to_parquet(path, index=False)
+    os.remove(path_a)
+    os.remove(path_b)
+    return path, {'pid': os.getpid(), 'seconds': time.perf_counter() - start, 'bytes': 0, 'tasks': 1}
+
+
+def expand_files(files: list[str]) -> list[str]:
+    """Split pysus dataset directories into their parquet chunks, so large UFs yield several tasks."""
+    expanded = []
+    for file in files:
+        if os.path.isdir(file):
+            expanded += sorted(os.path.join(root, name) for root, _, names in os.walk(file)
+                               for name in names if name.endswith('.parquet'))
+        else:
+            expanded.append(file)
+    return expanded
+
+
+def balance_report(stats: list[dict]) -> dict:
+    """Summarize how evenly the work was spread across the pool workers."""
+    workers = dict()
+    for stat in stats:
+        worker = workers.setdefault(stat['pid'], {'seconds': 0., 'bytes': 0, 'tasks': 0})
+        for key in worker:
+            worker[key] += stat[key]
+    busy = [worker['seconds'] for worker in workers.values()]
+    mean = sum(busy) / len(busy)
+    return {'workers': len(workers), 'tasks': len(stats),
+            'mean_busy_seconds': mean, 'min_busy_seconds': min(busy), 'max_busy_seconds': max(busy),
+            'imbalance': max(busy) / mean if mean > 0 else 1.,
+            'per_worker': workers}
+
+
+def agg_files_by_size(files: list[str], principal_diagnosis: list[str], num_cpus: int) -> pd.DataFrame:
+    """ Aggregates files one task per file, dispatching the largest ones first.
+
+        Each worker writes its partial aggregate to a temporary parquet file and, as soon as two
+        partials are ready, a worker merges them, so the partials are tree-reduced in the pool and
+        only the final aggregate is read by the parent process.
+
+    Args:
+        files (list[str]): The paths to the parquet files to process.
+        principal_diagnosis (list[str]): List of principal diagnoses to filter by.
+        num_cpus (int): Number of CPUs to use for parallel processing.
+
+    Returns:
+        pd.DataFrame: The aggregated data.
+    """
+    files = sorted(expand_files(files), key=lambda file: file_signature(file)['size'], reverse=True)
+    stats = []
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=num_cpus) as executor:
+        running = {executor.submit(process_file_to_path, (file, principal_diagnosis, tmp_dir)) for file in files}
+        ready = []
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, stat = future.result()
+                ready.append(path)
+                stats.append(stat)
+            while len(ready) >= 2:
+                running.add(executor.submit(merge_paths, (ready.pop(), ready.pop(), tmp_dir)))
+        data = pd.read_parquet(ready[0])
+
+    report = balance_report(stats)
+    print(f"{report['tasks']} tasks on {report['workers']} workers, busy time per worker "
+          f"min {report['min_busy_seconds']:.1f}s / mean {report['mean_busy_seconds']:.1f}s / "
+          f"max {report['max_busy_seconds']:.1f}s (imbalance {report['imbalance']:.2f})")
+    return data
+
+
+def agg_files_arrow(files: list[str], principal_diagnosis: list[str]) -> pd.DataFrame:
+    """ Aggregates files with a streaming Acero plan (scan, filter, project and hash aggregate) over an Arrow dataset.
+
+        The dataset only contains the files selected by UF and month, so those filters prune whole files
+        before the scan, and only the grouping columns are read.
+
+    Args:
+        files (list[str]): The paths to the parquet files to process.
+        principal_diagnosis (list[str]): List of principal diagnoses to filter by.
+
+    Returns:
+        pd.DataFrame: The aggregated data.
+    """
+    dataset = ds.dataset(expand_files(files), format='parquet')
+    diagnosis = pc.utf8_slice_codeunits(ds.field('DIAG_PRINC'), 0, 3)
+
+    # Same rows as the pandas path: group by drops null keys and blank municipalities are removed
+    keep = ds.field('DIAG_PRINC').is_valid() & ds.field('ANO_CMPT').is_valid() \
+        & ds.field('MUNIC_MOV').is_valid() & ds.field('MUNIC_RES').is_valid() \
+        & ~pc.utf8_is_space(ds.field('MUNIC_MOV')) & ~pc.utf8_is_space(ds.field('MUNIC_RES'))
+    if len(principal_diagnosis) > 0:
+        keep = keep & diagnosis.isin(principal_diagnosis)
+
+    plan = ac.Declaration.from_sequence([
+        ac.Declaration('scan', ac.ScanNodeOptions(dataset, columns=GROUP_COLUMNS, filter=keep)),
+        ac.Declaration('filter', ac.FilterNodeOptions(keep)),
+        ac.Declaration('project', ac.ProjectNodeOptions(
+            [ds.field('MUNIC_MOV'), ds.field('MUNIC_RES'), diagnosis, ds.field('ANO_CMPT')], GROUP_COLUMNS)),
+        ac.Declaration('aggregate', ac.AggregateNodeOptions(
+            [([], 'hash_count_all', None, 'HOSPITALIZACOES')], keys=GROUP_COLUMNS)),
+    ])
+    return plan.to_table().to_pandas()
+
+
+def agg_files_duckdb(files: list[str], principal_diagnosis: list[str], num_cpus: int) -> pd.DataFrame:
+    """ Aggregates files with an embedded DuckDB scan, which spills to disk if the groups do not fit in memory.
+
+        DuckDB is an optional dependency, only needed for this engine. Only the files selected by
+        UF and month are scanned, and only the grouping columns are read.
+
+    Args:
+        files (list[str]): The paths to the parquet files to process.
+        principal_diagnosis (list[str]): List of principal diagnoses to filter by.
+        num_cpus (int): Number of threads used by DuckDB.
+
+    Returns:
+        pd.DataFrame: The aggregated data.
+    """
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb engine requires the duckdb package (pip install duckdb).") from e
+
+    diagnosis_filter = 'AND DIAG_PRINC IN (SELECT unnest($diagnosis))' if len(principal_diagnosis) > 0 else ''
+    query = f"""
+        SELECT MUNIC_MOV, MUNIC_RES, DIAG_PRINC, ANO_CMPT, count(*) AS HOSPITALIZACOES
+        FROM (
+            SELECT MUNIC_MOV, MUNIC_RES, substr(DIAG_PRINC, 1, 3) AS DIAG_PRINC, ANO_CMPT
+            FROM read_parquet($files)
+        )
+        WHERE DIAG_PRINC IS NOT NULL AND ANO_CMPT IS NOT NULL
+            AND MUNIC_MOV IS NOT NULL AND MUNIC_RES IS NOT NULL
+            AND NOT regexp_full_match(MUNIC_MOV, '\\s+') AND NOT regexp_full_match(MUNIC_RES, '\\s+')
+            {diagnosis_filter}
+        GROUP BY ALL
+    """
+    params = {'files': expand_files(files)}
+    if len(principal_diagnosis) > 0:
+        params['diagnosis'] = list(principal_diagnosis)
+    with duckdb.connect() as con:
+        con.execute(f"SET threads = {num_cpus}")
+        return con.execute(query, params).df()
+
+
+@instrumented('transform.aggregate')
+def agg_num_hosp_city_hospital(uf: list[str]=[], months: list[int]=[], principal_diagnosis: list[str]=[], num_cpus: int=None,
+                               schedule: str='uf', engine: str='pandas', data_dir: str=SIH_DIR):
     """ Aggregates by selected months and states (UFs) and optionally filters by principal diagnosis.
         Then, we group the number of hospitalizations by county and hospital.
 
@@ -48,26 +306,37 @@ def agg_num_hosp_city_hospital(uf: list[str]=[], months: list[int]=[], principal
         months (list[int], optional): List of months to filter the data, if non empty list. Defaults to [].
         principal_diagnosis (list[str], optional): Principal diagnosis to filter the data, if provided. Defaults to [].
         num_cpus (int, optional): Number of CPUs to use for parallel processing. Defaults to None, which uses all available CPUs.
+        schedule (str, optional): 'uf' to process each UF in a single task, or 'size' to process one task per file,
+            largest first, merging the partial aggregates in the workers and reporting the load balance. Defaults to 'uf'.
+            Only used by the pandas engine.
+        engine (str, optional): 'pandas' to aggregate with pandas in a process pool, or 'arrow' / 'duckdb' to run
+            the same filter and group by as a single out-of-core columnar scan. Defaults to 'pandas'.
+        data_dir (str, optional): The directory of the SIH files. Defaults to SIH_DIR.
     """  
 
-    files = [f'data/SIH/{file}' for file in os.listdir('data/SIH') if file.endswith('.parquet')]
-    if len(uf) > 0:
-        files = [file for file in files if file[11:13] in uf] # Filter by UF (state)
-    if len(months) > 0:
-        files = [file for file in files if int(file[15:17]) in months] # Filter by month
-    if len(files) == 0:
-        raise ValueError("No files found matching the specified criteria.")
+    files = list_files(uf, months, data_dir)
+    num_cpus = num_cpus or os.cpu_count()
+    if engine in ('arrow', 'duckdb'):
+        data = agg_files_arrow(files, principal_diagnosis) if engine == 'arrow' \
+            else agg_files_duckdb(files, principal_diagnosis, num_cpus)
+        return data.sort_values(GROUP_COLUMNS, ignore_index=True)
+    elif engine != 'pandas':
+        raise ValueError(f"Unknown engine: {engine}")
+
+    if schedule == 'size':
+        return agg_files_by_size(files, principal_diagnosis, num_cpus)
+    elif schedule != 'uf':
+        raise ValueError(f"Unknown schedule: {schedule}")
     
     # group filesnames in a dictionary by UF
     grouped_files = dict()
     for file in files:
-        uf_code = file[11:13]
+        uf_code = file_uf(file)
         if uf_code not in grouped_files:
             grouped_files[uf_code] = []
         grouped_files[uf_code].append(file)
     
     # Aggregate the data in parallel
-    num_cpus = num_cpus or os.cpu_count()
     args = [(file_list, principal_diagnosis) for file_list in grouped_files.values()]
     with ProcessPoolExecutor(max_workers=num_cpus) as executor:
         data = list(executor.map(process_file_star, args))
@@ -76,6 +345,171 @@ def agg_num_hosp_city_hospital(uf: list[str]=[], months: list[int]=[], principal
     return data
 
 
+def to_output_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """ Cast an aggregate to the schema stored in hospitalizacoes.parquet.
+
+        Every key is an integer: the SIH municipality codes, the year and the CID_CODE of the
+        category (see src.dimensions) as DIAG_PRINC. Categories outside the CID-10 chapters table,
+        which have no chapter to be grouped by downstream, are dropped. Aggregates already in this
+        schema are returned as they are.
+    """
+    if not pd.api.types.is_integer_dtype(df['DIAG_PRINC']):
+        df = df.assign(DIAG_PRINC=encode_cid(df['DIAG_PRINC']))
+        df = df[df['DIAG_PRINC'] >= 0]
+    return df.astype({'MUNIC_MOV':np.int32,'MUNIC_RES':np.int32,'DIAG_PRINC':np.int16,
+                      'ANO_CMPT':np.int16,'HOSPITALIZACOES':np.int32})
+
+
+def file_signature(path: str) -> dict:
+    """Get the size and modification time of a parquet file or dataset directory."""
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    else:
+        stats = [os.stat(path)]
+    return {'size': sum(stat.st_size for stat in stats),
+            'mtime': max((stat.st_mtime_ns for stat in stats), default=0)}
+
+
+def file_hash(path: str) -> str:
+    """Get the SHA-256 of the contents of a parquet file or dataset directory."""
+    if os.path.isdir(path):
+        members = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        members = [path]
+    digest = hashlib.sha256()
+    for member in members:
+        with open(member, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest() -> dict:
+    """Load the ingest manifest, or an empty one if no incremental run was made yet."""
+    if not os.path.exists(MANIFEST_PATH):
+        return {'selection': None, 'files': {}}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict):
+    """Save the ingest manifest atomically."""
+    tmp_path = MANIFEST_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def partial_path(file: str) -> str:
+    """ Get the path of the per-file partial aggregate of an input file.
+
+        It is keyed by the full path of the file, as the manifest, so files with the same name in
+        another data directory do not share it.
+    """
+    key = hashlib.sha256(os.path.abspath(file).encode()).hexdigest()[:16]
+    return os.path.join(PARTIALS_DIR, f'{key}_{os.path.basename(file)}')
+
+
+def process_file_to_partial(args):
+    """ Helper function to aggregate a single file and persist its partial aggregate. """
+    file, principal_diagnosis = args
+    df = process_file([file], principal_diagnosis)
+    df.astype({'HOSPITALIZACOES': np.int64}).to_parquet(partial_path(file) + '.new', index=False)
+    return file
+
+
+def read_partials(paths: list[str]) -> pd.DataFrame:
+    """Read and sum partial aggregates."""
+    dfs = [pd.read_parquet(path) for path in paths]
+    if not dfs:
+        return pd.DataFrame(columns=GROUP_COLUMNS + ['HOSPITALIZACOES'])
+    df = pd.concat(dfs, ignore_index=True)
+    return df.groupby(GROUP_COLUMNS, as_index=False)['HOSPITALIZACOES'].sum()
+
+
+def agg_num_hosp_city_hospital_incremental(uf: list[str]=[], months: list[int]=[], principal_diagnosis: list[str]=[], num_cpus: int=None,
+                                           data_dir: str=SIH_DIR):
+    """ Incremental version of agg_num_hosp_city_hospital that only processes new or changed files,
+        saving the result to hospitalizacoes.parquet.
+
+        Every input file is recorded in a manifest (data/agg_data/manifest.json) with its size,
+        modification time and content hash, and its partial aggregate is kept in data/agg_data/partials.
+        Since counts are additive, the partials of changed and removed files are subtracted from the
+        existing hospitalizacoes.parquet and the new partials are added to it. If the selection of
+        UFs, months or diagnoses or the output schema changed, or the output was not written by the
+        last incremental run, the result is rebuilt from all the partials instead.
+
+    Args:
+        uf (list[str], optional): List of UFs (states) to filter the data, if non empty list. Defaults to [].
+        months (list[int], optional): List of months to filter the data, if non empty list. Defaults to [].
+        principal_diagnosis (list[str], optional): Principal diagnosis to filter the data, if provided. Defaults to [].
+        num_cpus (int, optional): Number of CPUs to use for parallel processing. Defaults to None, which uses all available CPUs.
+        data_dir (str, optional): The directory of the SIH files. Defaults to SIH_DIR.
+
+    Returns:
+        pd.DataFrame: The aggregated data, in the schema of hospitalizacoes.parquet.
+    """
+    files = list_files(uf, months, data_dir)
+    os.makedirs(PARTIALS_DIR, exist_ok=True)
+
+    manifest = load_manifest()
+    selection = {'uf': sorted(uf), 'months': sorted(months), 'principal_diagnosis': sorted(principal_diagnosis),
+                 'schema': SCHEMA_VERSION}
+    diagnosis_changed = manifest['selection'] is None or \
+        manifest['selection']['principal_diagnosis'] != selection['principal_diagnosis']
+    full_rebuild = manifest['selection'] != selection or not os.path.exists(OUTPUT_PATH) or \
+        manifest.get('output') != file_signature(OUTPUT_PATH)
+    # Changed and removed files can only be subtracted with their partial of the previous run
+    full_rebuild = full_rebuild or any(not os.path.exists(partial_path(file)) for file in manifest['files'])
+
+    # Find the files whose partial aggregate is missing or outdated
+    stale, changed, entries = [], [], {}
+    for file in files:
+        signature = file_signature(file)
+        entry = manifest['files'].get(file)
+        known = entry is not None and not diagnosis_changed and os.path.exists(partial_path(file))
+        if known and (entry['size'], entry['mtime']) == (signature['size'], signature['mtime']):
+            entries[file] = entry
+            continue
+        signature['hash'] = file_hash(file)
+        entries[file] = signature
+        if known and signature['hash'] == entry['hash']:
+            continue
+        if known:
+            changed.append(file)
+        stale.append(file)
+    removed = [file for file in manifest['files'] if file not in entries]
+    print(f"{len(stale)} new or changed files, {len(removed)} removed files, {len(files) - len(stale)} up to date")
+
+    num_cpus = num_cpus or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+        list(executor.map(process_file_to_partial, [(file, principal_diagnosis) for file in stale]))
+
+    if full_rebuild:
+        data = read_partials([partial_path(file) + '.new' if file in stale else partial_path(file) for file in files])
+    else:
+        new = read_partials([partial_path(file) + '.new' for file in stale])
+        old = read_partials([partial_path(file) for file in changed + removed if os.path.exists(partial_path(file))])
+        old['HOSPITALIZACOES'] = -old['HOSPITALIZACOES']
+        data = pd.concat([pd.read_parquet(OUTPUT_PATH), to_output_schema(new), to_output_schema(old)], ignore_index=True)
+        data = data.astype({'HOSPITALIZACOES': np.int64}) \
+            .groupby(GROUP_COLUMNS, as_index=False)['HOSPITALIZACOES'].sum()
+        data = data[data['HOSPITALIZACOES'] != 0]
+    data = to_output_schema(data)
+
+    # The manifest is saved last, so an interrupted run is detected and rebuilt on the next one
+    data.to_parquet(OUTPUT_PATH, index=False)
+    for file in stale:
+        os.replace(partial_path(file) + '.new', partial_path(file))
+    # Partials of removed files, or left by an interrupted run, are not needed anymore
+    current = {os.path.basename(partial_path(file)) for file in files}
+    for name in os.listdir(PARTIALS_DIR):
+        if name not in current:
+            os.remove(os.path.join(PARTIALS_DIR, name))
+    save_manifest({'selection': selection, 'files': entries, 'output': file_signature(OUTPUT_PATH)})
+    return data
+
+
 def get_city_name(city_codes: pd.Series) -> pd.Series:
     """Get the name of the city from its code."""
     city_names = pd.read_csv('data/aux_data/MUNIC_BR.csv', sep=';')
@@ -95,14 +529,34 @@ def get_state_name(city_codes: pd.Series) -> pd.Series:
 
 if __name__ == "__main__":
 
-    # cid10_chapters = pd.read_csv('data/CID10/cid10_capitulos.csv', sep=';')
-    # principal_diagnosis = cid10_chapters[cid10_chapters['descricao'].str.startswith('Capítulo I -')]['codigo'].tolist()
-    transformed_data: pd.DataFrame = agg_num_hosp_city_hospital(uf=[], principal_diagnosis=[])
-    print(transformed_data.head())
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process new or changed SIH files and merge them into the existing output.')
+    parser.add_argument('--schedule', choices=['uf', 'size'],
+                        help='Process one task per UF (the default), or one task per file with the largest files first. '
+                             'Not available with --incremental.')
+    parser.add_argument('--engine', choices=['pandas', 'arrow', 'duckdb'],
+                        help='Aggregate with pandas in a process pool (the default), or with an Arrow or DuckDB columnar scan. '
+                             'Not available with --incremental.')
+    parser.add_argument('--data-dir', default=SIH_DIR,
+                        help='Directory of the SIH files, e.g. the one written by src.synthetic_data.')
+    cli_args = parser.parse_args()
+    # The incremental ingest always aggregates each file on its own with pandas
+    if cli_args.incremental and (cli_args.schedule is not None or cli_args.engine is not None):
+        parser.error('--schedule and --engine cannot be used with --incremental')
+
     if not os.path.exists('data/agg_data'):
         os.makedirs('data/agg_data')
-    transformed_data.astype({'MUNIC_MOV':np.int32,'MUNIC_RES':np.int32,'DIAG_PRINC':'string',
-                             'ANO_CMPT':'string','HOSPITALIZACOES':np.int32}) \
-    .to_parquet('data/agg_data/hospitalizacoes.parquet', index=False)
+
+    # cid10_chapters = pd.read_csv('data/CID10/cid10_capitulos.csv', sep=';')
+    # principal_diagnosis = cid10_chapters[cid10_chapters['descricao'].str.startswith('Capítulo I -')]['codigo'].tolist()
+    if cli_args.incremental:
+        transformed_data: pd.DataFrame = agg_num_hosp_city_hospital_incremental(uf=[], principal_diagnosis=[],
+                                                                                        data_dir=cli_args.data_dir)
+        print(transformed_data.head())
+    else:
+        transformed_data: pd.DataFrame = agg_num_hosp_city_hospital(uf=[], principal_diagnosis=[], schedule=cli_args.schedule or 'uf',
+                                                                    engine=cli_args.engine or 'pandas', data_dir=cli_args.data_dir)
+        print(transformed_data.head())
+        to_output_schema(transformed_data).to_parquet(OUTPUT_PATH, index=False)
     print("Transformed data saved")